@@ -0,0 +1,207 @@
+# Offline benchmark: builds the real dp from run.py, answers Bot API calls with a
+# local stub session and feeds synthetic updates through dp.feed_update.
+#
+#   python bench.py --users 500 --rounds 3 --latency 20 --json
+#   python bench.py --registry 1000000     (registry memory: plain dicts vs load_data)
+#
+# Everything (snapshot, journal, FSM, logs) is written to a temp directory, and
+# the API rate limits are lifted unless --limits is given, so the numbers measure
+# the bot itself.
+import os
+import sys
+import asyncio
+import argparse
+import itertools
+import json
+import resource
+import shutil
+import tempfile
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# CONFIG
+parser = argparse.ArgumentParser(description="run.py throughput benchmark")
+parser.add_argument("--users", type=int, default=200, help="simulated users")
+parser.add_argument("--rounds", type=int, default=3, help="scenario rounds per user")
+parser.add_argument("--latency", type=float, default=0, help="fake Bot API latency, ms")
+parser.add_argument("--concurrency", type=int, default=100, help="users in flight")
+parser.add_argument("--scenario", default="all", choices=["all", "start", "nav", "add", "bulk"])
+parser.add_argument("--bulk-ids", type=int, default=50, help="user ids per bulk moderation")
+parser.add_argument("--limits", action="store_true", help="keep run.py API rate limits")
+parser.add_argument("--json", action="store_true", help="print one JSON line")
+parser.add_argument("--keep", action="store_true", help="keep the temp data directory")
+parser.add_argument("--registry", type=int, default=0, help="measure registry memory for N registrations instead")
+args = parser.parse_args()
+
+workdir = tempfile.mkdtemp(prefix="bench-")
+os.chdir(workdir)
+os.environ.update({"BOT_TOKEN": "123456:BENCH", "ADMIN_ID": "1", "METRICS_PORT": "0"})
+if not args.limits:
+    os.environ.update({"API_RATE": "1e9", "API_CHAT_RATE": "1e9", "API_GROUP_RATE": "1e9", "API_CHAT_BURST": "1000000000"})
+sys.path.insert(0, ROOT)
+
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram import types as T
+
+import run
+
+# STUB SESSION
+# Answers every method locally; --latency is awaited per call like a round trip.
+class StubSession(AiohttpSession):
+    def __init__(self, latency):
+        super().__init__()
+        self.latency = latency
+        self.calls = 0
+        self.ids = itertools.count(1)
+
+    async def make_request(self, bot, method, timeout=None):
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        name = type(method).__name__
+        chat_id = getattr(method, "chat_id", None)
+        if name == "GetChat":
+            return T.ChatFullInfo.model_construct(id=bench_chat_id(chat_id), type="channel", title=f"Bench {chat_id}", username=str(chat_id).lstrip("@"),
+                                                  description="", accent_color_id=0, max_reaction_count=0)
+        if name == "GetChatMember":
+            return T.ChatMemberAdministrator.model_construct(user=T.User(id=method.user_id, is_bot=True, first_name="bench"), status="administrator")
+        if name == "GetChatMemberCount":
+            return 1000
+        if name == "GetMe":
+            return T.User(id=123456, is_bot=True, first_name="bench", username="bench_bot")
+        if name == "SendMediaGroup":
+            return [self.message(bot, chat_id) for _ in method.media]
+        if name.startswith(("Send", "Edit")):
+            return self.message(bot, chat_id)
+        return True
+
+    def message(self, bot, chat_id):
+        chat = T.Chat(id=chat_id if isinstance(chat_id, int) else 0, type="private")
+        return T.Message(message_id=next(self.ids), date=datetime.now(), chat=chat).as_(bot)
+
+    async def close(self):
+        pass
+
+def bench_chat_id(chat_id):
+    if isinstance(chat_id, int):
+        return chat_id
+    return -1000000000000 - int(str(chat_id).removeprefix("@bench") or 0)
+
+# UPDATES
+update_ids = itertools.count(1)
+
+def user(uid):
+    return T.User(id=uid, is_bot=False, first_name="u", username=f"u{uid}")
+
+def text_update(uid, text):
+    msg = T.Message(message_id=next(update_ids), date=datetime.now(), chat=T.Chat(id=uid, type="private"), from_user=user(uid), text=text)
+    return T.Update(update_id=next(update_ids), message=msg)
+
+def callback_update(uid, data):
+    msg = T.Message(message_id=next(update_ids), date=datetime.now(), chat=T.Chat(id=uid, type="private"), from_user=user(uid), text="menu")
+    query = T.CallbackQuery(id=str(next(update_ids)), from_user=user(uid), chat_instance="bench", message=msg, data=data)
+    return T.Update(update_id=next(update_ids), callback_query=query)
+
+def scenario(uid, n):
+    chat_id = bench_chat_id(f"@bench{uid}")
+    steps = []
+    if args.scenario in ("all", "start"):
+        steps += [text_update(uid, "/start")]
+    if args.scenario in ("all", "add") or n == 0:
+        steps += [callback_update(uid, run.cbd("add_channel")), text_update(uid, f"@bench{uid}")]
+    if args.scenario in ("all", "nav"):
+        steps += [callback_update(uid, run.cbd("my_channels")), callback_update(uid, run.cbd("sel", chat_id)), callback_update(uid, run.cbd("mem", chat_id)),
+                  callback_update(uid, run.cbd("sel", chat_id)), callback_update(uid, run.cbd("main"))]
+    if args.scenario in ("all", "bulk"):
+        ids = " ".join(str(10 ** 9 + uid * 1000 + i) for i in range(args.bulk_ids))
+        steps += [callback_update(uid, run.cbd("bulk", chat_id)), callback_update(uid, run.cbd("bmod", "ban", chat_id)), text_update(uid, ids)]
+    return steps
+
+# REGISTRY MEMORY
+# N registrations, 5 per user, every chat owned by two users, written as a v2
+# snapshot. Measured: the parsed dicts as load_data used to keep them (plus the
+# chat_owners index), then what load_data builds now.
+def registry_bench(n):
+    users = {}
+    chats = max(n // 2, 1)
+    for i in range(n):
+        chat_id = -1000000000000 - i % chats
+        users.setdefault(str(10000 + i // 5), {})[str(chat_id)] = {"id": chat_id, "username": f"chan{i % chats}", "name": f"Channel {i % chats}",
+                                                                    "type": "channel" if i % 3 else "supergroup", "added": f"2026-01-{i % 28 + 1:02d} 12:{i % 60:02d}"}
+    with open(run.DATA_FILE, "w", encoding="utf-8") as f:
+        json.dump({"version": run.DATA_VERSION, "users": users}, f)
+    del users
+
+    tracemalloc.start()
+    with open(run.DATA_FILE, "r", encoding="utf-8") as f:
+        raw = json.load(f)
+    plain = {int(uid): {int(chat_id): ch for chat_id, ch in chans.items()} for uid, chans in raw["users"].items()}
+    owners = {}
+    for uid, chans in plain.items():
+        for chat_id in chans:
+            owners.setdefault(chat_id, set()).add(uid)
+    del raw
+    plain_bytes = tracemalloc.get_traced_memory()[0]
+    del plain, owners
+    base = tracemalloc.get_traced_memory()[0]
+    tracemalloc.reset_peak()
+    compact = run.load_data()
+    compact_bytes, peak = (m - base for m in tracemalloc.get_traced_memory())
+    tracemalloc.stop()
+    result = {"registrations": n, "chats": len(run.chat_info), "users": len(compact), "dict_mb": round(plain_bytes / 2 ** 20, 1),
+              "compact_mb": round(compact_bytes / 2 ** 20, 1), "load_peak_mb": round(peak / 2 ** 20, 1), "ratio": round(plain_bytes / max(compact_bytes, 1), 2)}
+    shutil.rmtree(workdir, ignore_errors=True)
+    return result
+
+# RUN
+async def main():
+    session = StubSession(args.latency / 1000)
+    session.middleware(run.api_scheduler)
+    run.bot.session = session
+    quiet = sys.stderr if args.json else sys.stdout
+    with redirect_stdout(quiet):
+        await run.on_startup()
+    latencies = []
+    limit = asyncio.Semaphore(args.concurrency)
+
+    async def drive(uid):
+        async with limit:
+            for n in range(args.rounds):
+                for update in scenario(uid, n):
+                    start = time.perf_counter()
+                    await run.dp.feed_update(run.bot, update)
+                    latencies.append(time.perf_counter() - start)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(drive(10000 + i) for i in range(args.users)))
+    elapsed = time.perf_counter() - started
+    with redirect_stdout(quiet):
+        await run.on_shutdown()
+    if not args.keep:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    latencies.sort()
+    pick = lambda q: latencies[min(len(latencies) - 1, int(len(latencies) * q))] * 1000
+    result = {"scenario": args.scenario, "users": args.users, "rounds": args.rounds, "latency_ms": args.latency,
+              "updates": len(latencies), "seconds": round(elapsed, 3), "updates_per_sec": round(len(latencies) / elapsed, 1),
+              "p50_ms": round(pick(0.5), 3), "p99_ms": round(pick(0.99), 3), "max_ms": round(latencies[-1] * 1000, 3),
+              "api_calls": session.calls, "channels": run.registry_stats["channels"],
+              "handler_errors": run.metric_total("bot_handler_errors_total", "counter"), "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)}
+    if args.json:
+        print(json.dumps(result))
+        return
+    print("=" * 40)
+    for key, value in result.items():
+        print(f"{key:>16}: {value}")
+    print("=" * 40)
+
+if __name__ == "__main__":
+    if args.registry:
+        result = registry_bench(args.registry)
+        print(json.dumps(result) if args.json else "\n".join(f"{key:>16}: {value}" for key, value in result.items()))
+    else:
+        asyncio.run(main())
@@ -1,43 +1,1169 @@
 import os
+import sys
+import signal
 import asyncio
+import io
 import json
-from datetime import datetime, timedelta
-from aiogram import Bot, Dispatcher, F
+import sqlite3
+import re
+import gzip
+import heapq
+import itertools
+import bisect
+import time
+import random
+import contextvars
+import inspect
+import hmac
+import secrets
+import shutil
+import threading
+import struct
+from array import array
+from collections import Counter, OrderedDict, deque
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from html import escape
+from aiohttp import web
+from aiogram import Bot, Dispatcher, F, BaseMiddleware
 from aiogram.filters import Command
-from aiogram.types import Message, FSInputFile, ChatPermissions, InputMediaPhoto, CallbackQuery
+from aiogram.exceptions import TelegramRetryAfter, TelegramBadRequest, TelegramForbiddenError
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.types import Update, Message, FSInputFile, BufferedInputFile, ChatPermissions, InputMediaPhoto, InputMediaVideo, InputMediaDocument, CallbackQuery
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder
 
 # CONFIG
 BOT_TOKEN = os.getenv("BOT_TOKEN", "your token")
 ADMIN_ID = int(os.getenv("ADMIN_ID", "your id"))
 
+BOT_MODE = "webhook" if "--webhook" in sys.argv else os.getenv("BOT_MODE", "polling")
+SHARDS = int(os.getenv("SHARDS", "0"))
+SHARD_ID = int(os.environ["SHARD_ID"]) if os.getenv("SHARD_ID") else None
+SHARD_CONCURRENCY = int(os.getenv("SHARD_CONCURRENCY", "64"))
+SHARD_RESPAWN_TIMEOUT = float(os.getenv("SHARD_RESPAWN_TIMEOUT", "10"))
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+# a public webhook must be authenticated: without WEBHOOK_SECRET a random one is
+# generated per start and registered with set_webhook
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or (secrets.token_urlsafe(32) if WEBHOOK_URL else "")
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "32"))
+WEBHOOK_QUEUE = int(os.getenv("WEBHOOK_QUEUE", "1000"))
+WEBHOOK_DRAIN_TIMEOUT = float(os.getenv("WEBHOOK_DRAIN_TIMEOUT", "30"))
+SHUTDOWN_DRAIN_TIMEOUT = float(os.getenv("SHUTDOWN_DRAIN_TIMEOUT", "30"))
+
 bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher(storage=MemoryStorage())
 
-DATA_FILE = "channels.json"
-LOG_FILE = "logs.txt"
+def shard_path(path, shard):
+    if shard is None:
+        return path
+    base, ext = os.path.splitext(path)
+    return f"{base}.shard{shard}{ext}"
+
+def shard_file(path):
+    return shard_path(path, SHARD_ID)
+
+BASE_DATA_FILE = "channels.json"
+BASE_JOURNAL_FILE = "channels.journal"
+LAYOUT_FILE = "channels.layout.json"
+LAYOUT_SHARDS = SHARDS if SHARDS > 1 else 0
+DATA_FILE = shard_file(BASE_DATA_FILE)
+JOURNAL_FILE = shard_file(BASE_JOURNAL_FILE)
+LOG_FILE = shard_file("logs.txt")
+BASE_FSM_FILE = os.getenv("FSM_FILE", "fsm.sqlite3")
+FSM_FILE = shard_file(BASE_FSM_FILE)
+FSM_HOT_SIZE = int(os.getenv("FSM_HOT_SIZE", "10000"))
+FSM_TTL = float(os.getenv("FSM_TTL", str(24 * 3600)))
+FSM_FLUSH_INTERVAL = float(os.getenv("FSM_FLUSH_INTERVAL", "1"))
+FSM_SWEEP_INTERVAL = float(os.getenv("FSM_SWEEP_INTERVAL", "60"))
+COMPACT_INTERVAL = int(os.getenv("COMPACT_INTERVAL", "300"))
+COMPACT_THRESHOLD = int(os.getenv("COMPACT_THRESHOLD", "1000"))
+JOURNAL_FSYNC = os.getenv("JOURNAL_FSYNC", "0") == "1"
+LOG_BATCH = int(os.getenv("LOG_BATCH", "200"))
+LOG_FLUSH_INTERVAL = float(os.getenv("LOG_FLUSH_INTERVAL", "2"))
+LOG_QUEUE_MAX = int(os.getenv("LOG_QUEUE_MAX", "100000"))
+BASE_LOG_DB = os.getenv("LOG_DB", "logs.sqlite3")
+LOG_DB = shard_file(BASE_LOG_DB)
+LOG_RETENTION_DAYS = int(os.getenv("LOG_RETENTION_DAYS", "365"))
+LOG_TAIL = int(os.getenv("LOG_TAIL", "1000"))
+LOG_QUERY_MAX = int(os.getenv("LOG_QUERY_MAX", "100000"))
+LOG_GZIP_OVER = int(os.getenv("LOG_GZIP_OVER", str(256 * 1024)))
+NOTIFY_INTERVAL = float(os.getenv("NOTIFY_INTERVAL", "300"))
+NOTIFY_LAST = int(os.getenv("NOTIFY_LAST", "10"))
+NOTIFY_IMMEDIATE = set(filter(None, os.getenv("NOTIFY_IMMEDIATE", "BANNED,DELETED").split(",")))
+NOTIFY_MUTED = set(filter(None, os.getenv("NOTIFY_MUTED", "").split(",")))
+API_RATE = float(os.getenv("API_RATE", "30")) / (SHARDS if SHARD_ID is not None and SHARDS else 1)
+API_CHAT_RATE = float(os.getenv("API_CHAT_RATE", "1"))
+API_GROUP_RATE = float(os.getenv("API_GROUP_RATE", "20")) / 60
+API_CHAT_BURST = int(os.getenv("API_CHAT_BURST", "3"))
+API_RETRIES = int(os.getenv("API_RETRIES", "3"))
+API_MAX_RETRY_AFTER = int(os.getenv("API_MAX_RETRY_AFTER", "60"))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "5"))
+BROADCAST_PROGRESS = float(os.getenv("BROADCAST_PROGRESS", "3"))
+CHAT_CACHE_TTL = float(os.getenv("CHAT_CACHE_TTL", "300"))
+CHAT_CACHE_SIZE = int(os.getenv("CHAT_CACHE_SIZE", "5000"))
+MEDIA_MAX_BYTES = int(os.getenv("MEDIA_MAX_BYTES", str(5 * 1024 * 1024)))
+MEDIA_CACHE_SIZE = int(os.getenv("MEDIA_CACHE_SIZE", "16"))
+MEDIA_CACHE_TTL = float(os.getenv("MEDIA_CACHE_TTL", "600"))
+ALBUM_DEBOUNCE = float(os.getenv("ALBUM_DEBOUNCE", "1.0"))
+ALBUM_MAX_ITEMS = int(os.getenv("ALBUM_MAX_ITEMS", "100"))
+ALBUM_TTL = int(os.getenv("ALBUM_TTL", "3600"))
+BASE_SCHEDULE_FILE = os.getenv("SCHEDULE_FILE", "schedule.json")
+SCHEDULE_FILE = shard_file(BASE_SCHEDULE_FILE)
+SCHEDULE_TZ = timezone(timedelta(hours=float(os.getenv("SCHEDULE_TZ_OFFSET", "5"))))
+SCHEDULE_CONCURRENCY = int(os.getenv("SCHEDULE_CONCURRENCY", "10"))
+SCHEDULE_CATCHUP = os.getenv("SCHEDULE_CATCHUP", "late")  # late: send missed jobs at once, skip: drop them
+SCHEDULE_GRACE = int(os.getenv("SCHEDULE_GRACE", "300"))
+SCHEDULE_MIN_EVERY = int(os.getenv("SCHEDULE_MIN_EVERY", "600"))
+SCHEDULE_MAX_JOBS = int(os.getenv("SCHEDULE_MAX_JOBS", "50"))
+BASE_INVITE_FILE = os.getenv("INVITE_FILE", "invites.json")
+INVITE_FILE = shard_file(BASE_INVITE_FILE)
+INVITE_TTL = int(os.getenv("INVITE_TTL", "86400"))  # lifetime of a limited link, seconds
+INVITE_LIMIT = int(os.getenv("INVITE_LIMIT", "100"))  # members per limited link, 0 = no limit
+INVITE_REFRESH = int(os.getenv("INVITE_REFRESH", "3600"))  # replace links expiring within this window
+INVITE_INTERVAL = int(os.getenv("INVITE_INTERVAL", "600"))
+INVITE_IDLE = int(os.getenv("INVITE_IDLE", str(7 * 86400)))  # stop refreshing chats nobody asked for since
+KEYBOARD_CACHE_SIZE = int(os.getenv("KEYBOARD_CACHE_SIZE", "10000"))
+BULK_CONCURRENCY = int(os.getenv("BULK_CONCURRENCY", "10"))
+BULK_MAX_IDS = int(os.getenv("BULK_MAX_IDS", "10000"))
+BULK_MAX_BYTES = int(os.getenv("BULK_MAX_BYTES", str(1024 * 1024)))
+HEALTH_INTERVAL = int(os.getenv("HEALTH_INTERVAL", "21600"))  # 0 disables the sweeper
+HEALTH_DELAY = int(os.getenv("HEALTH_DELAY", "60"))
+HEALTH_CONCURRENCY = int(os.getenv("HEALTH_CONCURRENCY", "4"))
+HEALTH_JITTER = float(os.getenv("HEALTH_JITTER", "1.0"))
+BASE_GROWTH_FILE = os.getenv("GROWTH_FILE", "growth.bin")
+GROWTH_FILE = shard_file(BASE_GROWTH_FILE)
+GROWTH_INTERVAL = int(os.getenv("GROWTH_INTERVAL", "3600"))  # 0 disables the sampler
+GROWTH_DELAY = int(os.getenv("GROWTH_DELAY", "120"))
+GROWTH_CONCURRENCY = int(os.getenv("GROWTH_CONCURRENCY", "4"))
+GROWTH_HOURS = int(os.getenv("GROWTH_HOURS", "192"))
+GROWTH_DAYS = int(os.getenv("GROWTH_DAYS", "366"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))  # 0 disables; shard N listens on METRICS_PORT + N
+PROFILE_SLOWEST = int(os.getenv("PROFILE_SLOWEST", "20"))
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.005"))
+PROFILE_MAX_SECONDS = int(os.getenv("PROFILE_MAX_SECONDS", "300"))
+PROFILE_TOP = int(os.getenv("PROFILE_TOP", "30"))
 
 # DATABASE
-def load_data():
+# channels.json is a snapshot; every change is appended to channels.journal first
+# and the journal is folded into the snapshot by compact_loop, in a thread that
+# reads the old snapshot and replays the rotated journal (write_snapshot).
+# In memory: user_channels[uid][chat_id] -> Channel, chat_owners[chat_id] -> {uid}.
+# A chat's fields are stored once in chat_info[chat_id]; each owner's Channel is
+# two slots (the shared ChatInfo and the added time as an int YYYYMMDDHHMM) and
+# reads like the old dict: ch["name"], ch["added"], ch.get("stale").
+DATA_VERSION = 2
+journal = None
+journal_size = 0
+snapshot_stale = False
+compact_lock = asyncio.Lock()
+compact_wakeup = asyncio.Event()
+chat_owners = {}
+chat_info = {}
+registry_stats = Counter()
+
+class ChatInfo:
+    __slots__ = ("id", "username", "name", "type", "stale")
+
+    def __init__(self, id, username, name, type, stale=None):
+        self.id = id
+        self.username = username
+        self.name = name
+        self.type = sys.intern(type)
+        self.stale = stale
+
+class Channel:
+    __slots__ = ("chat", "added")
+    KEYS = frozenset(ChatInfo.__slots__)
+
+    def __init__(self, chat, added):
+        self.chat = chat
+        self.added = added
+
+    def __getitem__(self, key):
+        if key == "added":
+            return format_added(self.added)
+        if key not in Channel.KEYS:
+            raise KeyError(key)
+        return getattr(self.chat, key)
+
+    def get(self, key, default=None):
+        value = self[key] if key == "added" or key in Channel.KEYS else None
+        return default if value is None else value
+
+    def as_dict(self):
+        info = self.chat
+        d = {"id": info.id, "username": info.username, "name": info.name, "type": info.type, "added": format_added(self.added)}
+        if info.stale:
+            d["stale"] = info.stale
+        return d
+
+def parse_added(text):
     try:
-        if os.path.exists(DATA_FILE):
-            with open(DATA_FILE, "r", encoding="utf-8") as f:
-                return {int(k): v for k, v in json.load(f).items()}
-        return {}
-    except:
-        return {}
-
-def save_data(data):
+        return int(text[0:4] + text[5:7] + text[8:10] + text[11:13] + text[14:16])
+    except (TypeError, ValueError):
+        return 0
+
+def format_added(n):
+    if not n:
+        return "-"
+    return f"{n // 100000000}-{n // 1000000 % 100:02d}-{n // 10000 % 100:02d} {n // 100 % 100:02d}:{n % 100:02d}"
+
+def link_channel(ch, refresh=False):
+    info = chat_info.get(ch["id"])
+    if info is None:
+        info = chat_info[ch["id"]] = ChatInfo(ch["id"], ch.get("username"), ch["name"], ch["type"], ch.get("stale"))
+        registry_stats["stale"] += bool(info.stale)
+    elif refresh:
+        info.username = ch.get("username")
+        info.name = ch["name"]
+    return Channel(info, parse_added(ch.get("added")))
+
+def apply_change(data, rec):
+    uid = rec["uid"]
+    chans = data.setdefault(uid, {})
+    if rec["op"] == "add":
+        chat_id = rec["ch"]["id"]
+        if chat_id not in chans:
+            registry_stats["channels"] += 1
+            chans[chat_id] = link_channel(rec["ch"], refresh=True)
+        chat_owners.setdefault(chat_id, set()).add(uid)
+    elif rec["op"] == "del":
+        if chans.pop(rec["id"], None) is not None:
+            registry_stats["channels"] -= 1
+        owners = chat_owners.get(rec["id"])
+        if owners is not None:
+            owners.discard(uid)
+            if not owners:
+                del chat_owners[rec["id"]]
+                info = chat_info.pop(rec["id"], None)
+                registry_stats["stale"] -= bool(info and info.stale)
+    elif rec["op"] == "title":
+        if rec["id"] in chans:
+            chans[rec["id"]].chat.name = rec["name"]
+    elif rec["op"] == "meta":
+        ch = chans.get(rec["id"])
+        if ch is not None:
+            info = ch.chat
+            registry_stats["stale"] += bool(rec["stale"]) - bool(info.stale)
+            info.name = rec["name"]
+            info.username = rec["username"]
+            info.stale = rec["stale"] or None
+
+def read_journal(path):
+    if not os.path.exists(path):
+        return []
+    with open(path, "rb") as f:
+        raw = f.read()
+    # a crash mid-append leaves a torn last line: drop it so new records start clean
+    good = raw.rfind(b"\n") + 1
+    if good < len(raw):
+        with open(path, "r+b") as f:
+            f.truncate(good)
+    return [json.loads(line) for line in raw[:good].splitlines() if line.strip()]
+
+def replay_journal(data, path):
+    records = read_journal(path)
+    for rec in records:
+        apply_change(data, rec)
+    return len(records)
+
+def migrate_data(raw, path):
+    # v1 layout: {"uid": [channel, ...]}, addressed by list position
+    if raw.get("version") == DATA_VERSION:
+        return raw["users"]
+    shutil.copyfile(path, path + ".v1")
+    return {uid: {str(ch["id"]): ch for ch in chans} for uid, chans in raw.items()}
+
+def shard_of(user_id):
+    return user_id % SHARDS if SHARDS else 0
+
+def write_atomic(path, dump):
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(dump)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+# LAYOUT
+# LAYOUT_FILE records how many shards the per-shard files are split into (0 for
+# the single unsharded set). When SHARDS changes, the unsharded process or the
+# sharded front re-partitions before any worker starts. The old files are copied
+# into a backup directory and the layout is marked pending. Then every file is
+# rebuilt for the new shards and the old ones are removed. A crash in between
+# repeats the work from the backup. The registry is the union of all snapshots
+# and journals. Schedules, FSM states and log rows are split by user id. Invites
+# and growth are chat caches, kept for the chats each new shard's users own.
+# Only files of the old layout are read, except logs; leftovers from another
+# layout are dropped (kept in the backup) instead of being loaded again.
+# Workers never filter: a snapshot from another layout stops them.
+SQLITE_SUFFIX = r"(?:-wal|-shm|-journal)?"
+LAYOUT_BASES = {BASE_DATA_FILE: "", BASE_JOURNAL_FILE: r"(?:\.old)?", BASE_SCHEDULE_FILE: "", BASE_INVITE_FILE: "",
+                BASE_GROWTH_FILE: "", BASE_LOG_DB: SQLITE_SUFFIX, BASE_FSM_FILE: SQLITE_SUFFIX}
+
+def layout_pattern(base, suffix=""):
+    stem, ext = os.path.splitext(os.path.basename(base))
+    return re.compile(re.escape(stem) + r"(?:\.shard(\d+))?" + re.escape(ext) + suffix)
+
+def layout_files():
+    files = {}
+    for base, suffix in LAYOUT_BASES.items():
+        root = os.path.dirname(base)
+        pattern = layout_pattern(base, suffix)
+        for name in os.listdir(root or "."):
+            if m := pattern.fullmatch(name):
+                files[os.path.join(root, name)] = m[1]
+    return files
+
+def in_layout(shard, shards):
+    return shard is None if not shards else shard is not None and int(shard) < shards
+
+def layout_path(root, base, shard):
+    return os.path.join(root, os.path.basename(shard_path(base, shard)))
+
+def layout_sources(root, base, shards):
+    paths = (layout_path(root, base, shard) for shard in (range(shards) if shards else [None]))
+    return [path for path in paths if os.path.exists(path)]
+
+def new_shard(uid):
+    return int(uid) % LAYOUT_SHARDS if LAYOUT_SHARDS else None
+
+def read_layout():
+    if os.path.exists(LAYOUT_FILE):
+        with open(LAYOUT_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    # files from before LAYOUT_FILE: the highest shard number gives the count
+    shards = [int(shard) for shard in layout_files().values() if shard is not None]
+    return {"shards": max(shards) + 1 if shards else 0, "legacy": True}
+
+# Snapshots are written one user per line inside the JSON object, so they can be
+# read and written a line at a time: a single json.load/dumps of the whole
+# registry holds the GIL from start to end and would stall the loop even in a
+# thread. Snapshots in any other layout are read with json.load.
+def snapshot_lines(users, shards):
+    yield f'{{"version": {DATA_VERSION}, "shards": {shards}, "users": {{\n'
+    sep = ""
+    for uid, chans in users.items():
+        yield f"{sep}{json.dumps(str(uid))}: {json.dumps(chans, ensure_ascii=False)}"
+        sep = ",\n"
+    yield "\n}}\n"
+
+def read_users(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        head = f.readline()
+        if not (head.startswith('{"version": %d,' % DATA_VERSION) and head.rstrip().endswith('"users": {')):
+            f.seek(0)
+            return migrate_data(json.load(f), path)
+        users = {}
+        for line in f:
+            line = line.rstrip().rstrip(",")
+            if line and line != "}}":
+                users.update(json.loads("{" + line + "}"))
+        return users
+
+def apply_raw(users, chats, owners, rec):
+    chans = users.setdefault(str(rec["uid"]), {})
+    if rec["op"] == "add":
+        key = str(rec["ch"]["id"])
+        if key not in chans:
+            chans[key] = dict(rec["ch"])
+            if owners[key]:
+                chats.setdefault(key, {}).update(name=rec["ch"]["name"], username=rec["ch"].get("username"))
+            else:
+                chats[key] = {"name": rec["ch"]["name"], "username": rec["ch"].get("username"), "stale": rec["ch"].get("stale")}
+            owners[key] += 1
+    elif rec["op"] == "del":
+        key = str(rec["id"])
+        if chans.pop(key, None) is not None:
+            owners[key] -= 1
+            if not owners[key]:
+                chats.pop(key, None)
+    elif str(rec["id"]) in chans:
+        fields = {"name": rec["name"]} if rec["op"] == "title" else {"name": rec["name"], "username": rec["username"], "stale": rec["stale"] or None}
+        chats.setdefault(str(rec["id"]), {}).update(fields)
+
+def fold_journal(users, paths):
+    # apply_change on snapshot dicts: chat fields are shared by all owners, so they
+    # are collected per chat and copied to every owner's dict at the end
+    owners = Counter(key for chans in users.values() for key in chans)
+    chats = {}
+    for path in paths:
+        for rec in read_journal(path):
+            apply_raw(users, chats, owners, rec)
+    for chans in users.values():
+        for key, ch in chans.items():
+            ch.update(chats.get(key, ()))
+            if not ch.get("stale"):
+                ch.pop("stale", None)
+    return users
+
+def union_layout(shards, root):
+    # the unsharded files are the oldest generation; a shard's snapshot replaces
+    # its users wholesale, and each journal is replayed after its snapshot
+    users = read_users(layout_path(root, BASE_DATA_FILE, None)) or {}
+    fold_journal(users, [layout_path(root, BASE_JOURNAL_FILE, None) + suffix for suffix in (".old", "")])
+    for shard in range(shards):
+        part = read_users(layout_path(root, BASE_DATA_FILE, shard))
+        if part is not None:
+            for uid in [uid for uid in users if int(uid) % shards == shard]:
+                del users[uid]
+            users.update(part)
+        fold_journal(users, [layout_path(root, BASE_JOURNAL_FILE, shard) + suffix for suffix in (".old", "")])
+    return users
+
+def split_schedule(shards, root):
+    # job ids are counted per shard: a job keeps its id unless the new file has it
+    jobs = sorted((job for path in layout_sources(root, BASE_SCHEDULE_FILE, shards) for job in read_schedule(path)),
+                  key=lambda job: (job["due"], job["id"]))
+    parts, next_id = {}, max((job["id"] for job in jobs), default=0) + 1
+    for job in jobs:
+        part = parts.setdefault(new_shard(job["uid"]), {})
+        if job["id"] in part:
+            job["id"], next_id = next_id, next_id + 1
+        part[job["id"]] = job
+    return {shard: list(part.values()) for shard, part in parts.items()}
+
+def union_invites(shards, root):
+    chats = {}
+    for path in layout_sources(root, BASE_INVITE_FILE, shards):
+        for chat_id, entry in read_invites(path).items():
+            old = chats.setdefault(chat_id, entry)
+            if old is not entry:
+                newer, other = (entry, old) if entry.get("used", 0) > old.get("used", 0) else (old, entry)
+                links = {link["link"]: link for link in other["links"] + newer["links"]}
+                chats[chat_id] = {**newer, "primary": newer["primary"] or other["primary"], "links": list(links.values())}
+    return chats
+
+def union_growth(shards, root):
+    # shards owning the same chat sample the same counts; the newest series wins
+    series = {}
+    for path in layout_sources(root, BASE_GROWTH_FILE, shards):
+        for chat_id, s in read_growth(path).items():
+            if chat_id not in series or s.hour > series[chat_id].hour:
+                series[chat_id] = s
+    return series
+
+def split_fsm(shards, root, dbs):
+    # keys end in ":<user id>:<destiny>"; the most recently touched copy wins
+    rows = {}
+    for path in layout_sources(root, BASE_FSM_FILE, shards):
+        old = sqlite3.connect(path)
+        try:
+            for row in old.execute("SELECT key, state, data, touched FROM fsm"):
+                if row[0] not in rows or row[3] > rows[row[0]][3]:
+                    rows[row[0]] = row
+        finally:
+            old.close()
+    for key, row in rows.items():
+        try:
+            shard = new_shard(key.split(":")[-2])
+        except (ValueError, IndexError):
+            continue
+        dbs[shard].execute("INSERT INTO fsm VALUES (?, ?, ?, ?)", row)
+
+def split_logs(root, dbs):
+    # every generation is history, so all log databases are merged by time
+    names = [name for name in os.listdir(root) if layout_pattern(BASE_LOG_DB).fullmatch(name)]
+    olds = [sqlite3.connect(os.path.join(root, name)) for name in names]
     try:
-        with open(DATA_FILE, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-    except:
-        pass
+        rows = heapq.merge(*(old.execute("SELECT ts, id, user_id, username, action, chat_id, details FROM log ORDER BY ts, id") for old in olds))
+        for batch in iter(lambda: list(itertools.islice(rows, 10000)), []):
+            for ts, _, user_id, *rest in batch:
+                dbs[new_shard(user_id or 0)].execute("INSERT INTO log (ts, user_id, username, action, chat_id, details) VALUES (?, ?, ?, ?, ?, ?)", (ts, user_id, *rest))
+    finally:
+        for old in olds:
+            old.close()
+
+def ensure_layout():
+    layout = read_layout()
+    if "pending" not in layout:
+        stray = [name for name, shard in layout_files().items() if not in_layout(shard, LAYOUT_SHARDS)]
+        if layout["shards"] == LAYOUT_SHARDS and not layout.get("legacy") and not stray:
+            return
+        if layout["shards"] == LAYOUT_SHARDS == 0 and not stray:
+            # plain unsharded install from before LAYOUT_FILE: nothing to move
+            write_atomic(LAYOUT_FILE, json.dumps({"shards": 0}).encode("utf-8"))
+            return
+        backup = f"{os.path.splitext(BASE_DATA_FILE)[0]}.layout{layout['shards']}-{int(time.time())}"
+        os.makedirs(backup)
+        for name in layout_files():
+            shutil.copy2(name, os.path.join(backup, os.path.basename(name)))
+        layout = {"shards": layout["shards"], "pending": LAYOUT_SHARDS, "backup": backup}
+        write_atomic(LAYOUT_FILE, json.dumps(layout).encode("utf-8"))
+    shards, root = layout["shards"], layout["backup"]
+    users = union_layout(shards, root)
+    print(f"🧩 Registry: {shards} -> {LAYOUT_SHARDS} shards, {len(users)} users (backup: {root})")
+    for name in layout_files():
+        os.remove(name)
+    jobs = split_schedule(shards, root)
+    invites = union_invites(shards, root)
+    series = union_growth(shards, root)
+    targets = range(LAYOUT_SHARDS) if LAYOUT_SHARDS else [None]
+    for shard in targets:
+        part = {uid: chans for uid, chans in users.items() if new_shard(uid) == shard}
+        owned = {key for chans in part.values() for key in chans}
+        write_atomic(shard_path(BASE_DATA_FILE, shard), "".join(snapshot_lines(part, LAYOUT_SHARDS)).encode("utf-8"))
+        if shard in jobs:
+            write_atomic(shard_path(BASE_SCHEDULE_FILE, shard), dump_schedule(jobs[shard]))
+        if invites:
+            write_atomic(shard_path(BASE_INVITE_FILE, shard), dump_invites({key: e for key, e in invites.items() if key in owned}))
+        if series:
+            write_atomic(shard_path(BASE_GROWTH_FILE, shard), dump_growth({key: s for key, s in series.items() if str(key) in owned}))
+    for base, schema, split in ((BASE_FSM_FILE, FSM_SCHEMA, lambda dbs: split_fsm(shards, root, dbs)), (BASE_LOG_DB, LOG_SCHEMA, lambda dbs: split_logs(root, dbs))):
+        dbs = {shard: sqlite3.connect(shard_path(base, shard)) for shard in targets}
+        try:
+            for db in dbs.values():
+                db.executescript(schema)
+            split(dbs)
+            for db in dbs.values():
+                db.commit()
+        finally:
+            for db in dbs.values():
+                db.close()
+    write_atomic(LAYOUT_FILE, json.dumps({"shards": LAYOUT_SHARDS}).encode("utf-8"))
 
-user_channels = load_data()
+def load_data():
+    global journal_size, snapshot_stale
+    data = {}
+    if SHARD_ID is None:
+        ensure_layout()
+    users = {}
+    if os.path.exists(DATA_FILE):
+        with open(DATA_FILE, "r", encoding="utf-8") as f:
+            raw = json.load(f)
+        if raw.get("shards", 0) != LAYOUT_SHARDS:
+            raise SystemExit(f"❌ {DATA_FILE}: {raw.get('shards', 0)} shard uchun yozilgan, SHARDS={SHARDS}")
+        users = migrate_data(raw, DATA_FILE)
+        snapshot_stale = raw.get("version") != DATA_VERSION
+        del raw
+    chat_owners.clear()
+    chat_info.clear()
+    registry_stats["stale"] = 0
+    while users:
+        # popitem frees each user's parsed dicts as soon as they are converted
+        uid, chans = users.popitem()
+        # keyed by ChatInfo.id so every owner shares one int object per chat
+        data[int(uid)] = {channel.chat.id: channel for channel in map(link_channel, chans.values())}
+    registry_stats["channels"] = sum(len(chans) for chans in data.values())
+    for uid, chans in data.items():
+        for chat_id in chans:
+            chat_owners.setdefault(chat_id, set()).add(uid)
+    journal_size = replay_journal(data, JOURNAL_FILE + ".old") + replay_journal(data, JOURNAL_FILE)
+    if SHARD_ID is not None and any(shard_of(uid) != SHARD_ID for uid in data):
+        raise SystemExit(f"❌ {DATA_FILE}: boshqa shard foydalanuvchilari bor, SHARDS={SHARDS}")
+    return data
+
+def commit(rec):
+    global journal, journal_size
+    if journal is None:
+        journal = open(JOURNAL_FILE, "ab")
+    pos = journal.tell()
+    try:
+        journal.write((json.dumps(rec, ensure_ascii=False) + "\n").encode("utf-8"))
+        journal.flush()
+        if JOURNAL_FSYNC:
+            os.fsync(journal.fileno())
+    except Exception:
+        try:
+            journal.truncate(pos)
+        except Exception:
+            pass
+        raise
+    apply_change(user_channels, rec)
+    if rec["op"] in ("title", "meta"):
+        # shared chat fields changed: every owner's channel list is out of date
+        for owner in chat_owners.get(rec["id"], ()):
+            list_versions[owner] += 1
+    else:
+        list_versions[rec["uid"]] += 1
+    journal_size += 1
+    if journal_size >= COMPACT_THRESHOLD:
+        compact_wakeup.set()
+
+def write_snapshot():
+    # runs in a thread: the previous snapshot plus the rotated journal give the
+    # registry as of the rotation, without walking user_channels on the loop
+    old = JOURNAL_FILE + ".old"
+    users = fold_journal(read_users(DATA_FILE) or {}, [old])
+    tmp = DATA_FILE + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.writelines(snapshot_lines(users, LAYOUT_SHARDS))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, DATA_FILE)
+    if os.path.exists(old):
+        os.remove(old)
+
+async def compact_data():
+    global journal, journal_size, snapshot_stale
+    async with compact_lock:
+        if journal is not None:
+            journal.close()
+            journal = None
+        old = JOURNAL_FILE + ".old"
+        if os.path.exists(JOURNAL_FILE):
+            if os.path.exists(old):
+                # previous compaction failed: keep its records until a snapshot lands
+                with open(old, "ab") as dst, open(JOURNAL_FILE, "rb") as src:
+                    shutil.copyfileobj(src, dst)
+                os.remove(JOURNAL_FILE)
+            else:
+                os.replace(JOURNAL_FILE, old)
+        journal_size = 0
+        snapshot_stale = False
+        compact_wakeup.clear()
+        await asyncio.to_thread(write_snapshot)
+
+async def compact_loop():
+    while True:
+        try:
+            await asyncio.wait_for(compact_wakeup.wait(), COMPACT_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        if journal_size or snapshot_stale or os.path.exists(JOURNAL_FILE + ".old"):
+            try:
+                await compact_data()
+            except Exception as e:
+                print(f"❌ Compact: {e}")
+
+# METRICS
+# Counters and latency histograms are updated in place by the update/handler
+# middlewares and by api_scheduler; gauges only read sizes that are already kept,
+# so nothing is recomputed by scanning. /metrics serves them in Prometheus format.
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+metric_counters = Counter()
+metric_histograms = {}
+metrics_runner = None
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(METRIC_BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(METRIC_BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+def inc(name, value=1, **labels):
+    metric_counters[(name, tuple(sorted(labels.items())))] += value
+
+def observe(name, value, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    hist = metric_histograms.get(key)
+    if hist is None:
+        hist = metric_histograms[key] = Histogram()
+    hist.observe(value)
+
+def metric_total(name, field="count"):
+    if field == "counter":
+        return sum(v for (n, _), v in metric_counters.items() if n == name)
+    return sum(getattr(h, field) for (n, _), h in metric_histograms.items() if n == name)
+
+def metric_gauges():
+    return {"bot_users": len(user_channels), "bot_channels": registry_stats["channels"], "bot_stale_channels": registry_stats["stale"], "bot_chats": len(chat_owners),
+            "bot_fsm_live": fsm_storage.live, "bot_fsm_hot": len(fsm_storage.hot), "bot_fsm_dirty": len(fsm_storage.dirty),
+            "bot_chat_cache_size": len(chat_cache.entries), "bot_log_queue": len(log_queue),
+            "bot_scheduled_jobs": len(scheduled_jobs), "bot_api_waiters": len(api_scheduler.waiters)}
+
+def format_labels(labels):
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}" if labels else ""
+
+def render_metrics():
+    lines = []
+    for kind, items in (("counter", metric_counters), ("histogram", metric_histograms)):
+        seen = set()
+        for (name, labels), value in sorted(items.items()):
+            if name not in seen:
+                seen.add(name)
+                lines.append(f"# TYPE {name} {kind}")
+            if kind == "counter":
+                lines.append(f"{name}{format_labels(labels)} {value}")
+                continue
+            total = 0
+            for bound, n in zip(METRIC_BUCKETS + ("+Inf",), value.counts):
+                total += n
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', bound),))} {total}")
+            lines.append(f"{name}_sum{format_labels(labels)} {value.sum:.6f}")
+            lines.append(f"{name}_count{format_labels(labels)} {value.count}")
+    for name, value in metric_gauges().items():
+        lines.append(f"# TYPE {name} gauge\n{name} {value}")
+    return "\n".join(lines) + "\n"
+
+async def metrics_handler(request):
+    return web.Response(text=render_metrics(), content_type="text/plain", headers={"X-Content-Type-Options": "nosniff"})
+
+async def start_metrics():
+    global metrics_runner
+    if not METRICS_PORT:
+        return
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, METRICS_HOST, METRICS_PORT + (SHARD_ID or 0)).start()
+    except OSError as e:
+        print(f"❌ Metrics: {e}")
+        await runner.cleanup()
+        return
+    metrics_runner = runner
+
+async def stop_metrics():
+    global metrics_runner
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+        metrics_runner = None
+
+class HandlerMetrics(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        # route_callback overwrites trace["handler"] with the callback it dispatched to
+        trace = data.get("trace", {})
+        trace["handler"] = data["handler"].callback.__name__
+        start = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            inc("bot_handler_errors_total", handler=trace["handler"])
+            raise
+        finally:
+            observe("bot_handler_seconds", time.perf_counter() - start, handler=trace["handler"])
+
+# updates_idle is set while no update is being handled; on_shutdown waits for it
+# because aiogram's polling does not wait for the handler tasks it started.
+updates_running = 0
+updates_idle = asyncio.Event()
+updates_idle.set()
+
+class UpdateMetrics(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        global updates_running
+        trace = data["trace"] = {}
+        start = time.perf_counter()
+        updates_running += 1
+        updates_idle.clear()
+        try:
+            return await handler(event, data)
+        finally:
+            updates_running -= 1
+            if not updates_running:
+                updates_idle.set()
+            seconds = time.perf_counter() - start
+            observe("bot_update_seconds", seconds, type=event.event_type)
+            record_slow(seconds, event, trace)
+
+# PROFILE
+# UpdateMetrics keeps the PROFILE_SLOWEST slowest updates in a min-heap, which
+# costs one comparison for a normal update. /profile N starts a thread that samples
+# the event loop thread's stack every PROFILE_INTERVAL seconds for N seconds;
+# outside that window nothing is sampled. The sampler needs the GIL, so it mostly
+# sees code that holds the loop for longer than sys.getswitchinterval() - which is
+# what makes the bot lag.
+slow_updates = []
+slow_seq = itertools.count()
+profile_task = None
+
+def record_slow(seconds, event, trace):
+    if len(slow_updates) >= PROFILE_SLOWEST and seconds <= slow_updates[0][0]:
+        return
+    inner = event.event
+    user = getattr(inner, "from_user", None)
+    info = {"ms": seconds * 1000, "type": event.event_type, "handler": trace.get("handler", "-"), "user": user.id if user else None,
+            "data": getattr(inner, "data", None) or (getattr(inner, "text", None) or "")[:40], "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
+    if len(slow_updates) >= PROFILE_SLOWEST:
+        heapq.heapreplace(slow_updates, (seconds, next(slow_seq), info))
+    else:
+        heapq.heappush(slow_updates, (seconds, next(slow_seq), info))
+
+def format_slow():
+    return [f"{u['ms']:.0f} ms | {u['type']} | {u['handler']} | {u['data']} | {u['user']} | {u['time']}" for _, _, u in sorted(slow_updates, reverse=True)]
+
+def sample_stacks(thread_id, seconds):
+    stacks = Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        stack = []
+        while frame is not None:
+            stack.append(f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}:{frame.f_lineno}")
+            frame = frame.f_back
+        stacks[";".join(reversed(stack))] += 1
+        time.sleep(PROFILE_INTERVAL)
+    return stacks
+
+def profile_report(stacks, seconds):
+    total = sum(stacks.values()) or 1
+    # the loop thread parked in select() is waiting for I/O, not doing work
+    busy = Counter({stack: n for stack, n in stacks.items() if not stack.rsplit(";", 1)[-1].startswith("selectors.py:select")})
+    functions = Counter()
+    for stack, n in busy.items():
+        functions[stack.rsplit(";", 1)[-1]] += n
+    lines = [f"window: {seconds}s, samples: {total}, busy: {sum(busy.values())} ({sum(busy.values()) * 100 / total:.1f}%)", "", "== top functions (self) =="]
+    lines += [f"{n * 100 / total:6.2f}%  {name}" for name, n in functions.most_common(PROFILE_TOP)]
+    lines += ["", "== top stacks =="]
+    for stack, n in busy.most_common(PROFILE_TOP):
+        lines += [f"{n * 100 / total:6.2f}%"] + [f"    {frame}" for frame in stack.split(";")[-15:]] + [""]
+    lines += ["== slowest updates =="] + format_slow()
+    lines += ["", "== collapsed (flamegraph) =="] + [f"{stack} {n}" for stack, n in stacks.most_common()]
+    return "\n".join(lines) + "\n"
+
+async def run_profile(chat_id, seconds):
+    try:
+        stacks = await asyncio.to_thread(sample_stacks, threading.get_ident(), seconds)
+        report = profile_report(stacks, seconds).encode("utf-8")
+        await bot.send_document(chat_id, BufferedInputFile(report, filename="profile.txt"), caption=f"⏱ <b>Profil</b>: {seconds}s", parse_mode="HTML")
+    except Exception as e:
+        print(f"❌ Profile: {e}")
+
+# API LIMITS
+# Every Bot API call goes through api_scheduler (a session middleware): one global
+# bucket shared by all calls, one bucket per target chat for messages, and 429s
+# are retried after retry_after. Bulk jobs lower their priority with api_priority.
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 10
+api_priority = contextvars.ContextVar("api_priority", default=PRIORITY_INTERACTIVE)
+CHAT_LIMITED = ("send", "copy", "forward")
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.stamp = time.monotonic()
+
+    def take(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def block(self, seconds):
+        self.take()
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+class ApiScheduler(BaseRequestMiddleware):
+    def __init__(self, rate, chat_rate, group_rate, chat_burst, max_chats=10000):
+        self.bucket = TokenBucket(rate, rate)
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.chat_burst = chat_burst
+        self.max_chats = max_chats
+        self.chats = {}
+        self.waiters = []
+        self.seq = itertools.count()
+        self.pump_task = None
+        self.stats = Counter()
+
+    def chat_bucket(self, chat_id):
+        bucket = self.chats.pop(chat_id, None)
+        if bucket is None:
+            group = isinstance(chat_id, str) or chat_id < 0
+            bucket = TokenBucket(self.group_rate if group else self.chat_rate, self.chat_burst)
+            if len(self.chats) >= self.max_chats:
+                del self.chats[next(iter(self.chats))]
+        self.chats[chat_id] = bucket
+        return bucket
+
+    async def take_chat(self, chat_id):
+        bucket = self.chat_bucket(chat_id)
+        while delay := bucket.take():
+            await asyncio.sleep(delay)
+
+    async def take_global(self, priority):
+        if not self.waiters and not self.bucket.take():
+            return
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self.seq), fut))
+        if self.pump_task is None or self.pump_task.done():
+            self.pump_task = asyncio.create_task(self.pump())
+        await fut
+
+    async def pump(self):
+        while self.waiters:
+            if delay := self.bucket.take():
+                await asyncio.sleep(delay)
+                continue
+            fut = heapq.heappop(self.waiters)[2]
+            if not fut.done():
+                fut.set_result(None)
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        limited = chat_id is not None and method.__api_method__.startswith(CHAT_LIMITED)
+        for attempt in range(API_RETRIES + 1):
+            if limited:
+                await self.take_chat(chat_id)
+            await self.take_global(api_priority.get())
+            start = time.perf_counter()
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                self.stats["retry_after"] += 1
+                inc("bot_api_retry_after_total", method=method.__api_method__)
+                if attempt == API_RETRIES or e.retry_after > API_MAX_RETRY_AFTER:
+                    raise
+                if limited:
+                    self.chat_bucket(chat_id).block(e.retry_after)
+                else:
+                    self.bucket.block(e.retry_after)
+                retry_after = e.retry_after
+            except Exception as e:
+                inc("bot_api_errors_total", method=method.__api_method__, error=type(e).__name__)
+                raise
+            finally:
+                observe("bot_api_seconds", time.perf_counter() - start, method=method.__api_method__)
+            await asyncio.sleep(retry_after)
+
+api_scheduler = ApiScheduler(API_RATE, API_CHAT_RATE, API_GROUP_RATE, API_CHAT_BURST)
+bot.session.middleware(api_scheduler)
+
+# CHAT CACHE
+# get_chat and member count per chat, kept for CHAT_CACHE_TTL seconds in an LRU.
+# Concurrent lookups for the same key share one request. The bot's admin status
+# is a precondition that the user fixes and retries at once, so it is always
+# asked fresh and never cached.
+class TTLCache:
+    def __init__(self, ttl, size):
+        self.ttl = ttl
+        self.size = size
+        self.entries = OrderedDict()
+        self.inflight = {}
+        self.stats = Counter()
+
+    async def get(self, key, loader):
+        entry = self.entries.get(key)
+        if entry and entry[0] > time.monotonic():
+            self.entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return entry[1]
+        if key in self.inflight:
+            self.stats["coalesced"] += 1
+            return await asyncio.shield(self.inflight[key])
+        self.stats["misses"] += 1
+        fut = asyncio.get_running_loop().create_future()
+        self.inflight[key] = fut
+        try:
+            value = await loader()
+        except BaseException as e:
+            if isinstance(e, Exception):
+                fut.set_exception(e)
+                fut.exception()
+            else:
+                fut.cancel()
+            if self.inflight.get(key) is fut:
+                del self.inflight[key]
+            raise
+        fut.set_result(value)
+        if self.inflight.get(key) is fut:
+            del self.inflight[key]
+            self.put(key, value)
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, key):
+        self.entries.pop(key, None)
+        self.inflight.pop(key, None)
+
+chat_cache = TTLCache(CHAT_CACHE_TTL, CHAT_CACHE_SIZE)
+
+def cached_chat(chat_id):
+    return chat_cache.get(("chat", chat_id), lambda: bot.get_chat(chat_id=chat_id))
+
+def cached_member_count(chat_id):
+    return chat_cache.get(("count", chat_id), lambda: bot.get_chat_member_count(chat_id=chat_id))
+
+def invalidate_chat(chat_id):
+    for kind in ("chat", "count"):
+        chat_cache.invalidate((kind, chat_id))
+
+# FSM STORAGE
+# SQLite-backed FSM storage. Recently used records live in an LRU "hot" dict;
+# changes are written through by a background flusher, and records idle for
+# longer than FSM_TTL are dropped from both tiers.
+class FsmRecord:
+    __slots__ = ("state", "data", "touched")
+
+    def __init__(self, state=None, data=None, touched=0.0):
+        self.state = state
+        self.data = data or {}
+        self.touched = touched
+
+FSM_SCHEMA = """
+CREATE TABLE IF NOT EXISTS fsm (key TEXT PRIMARY KEY, state TEXT, data TEXT, touched REAL);
+CREATE INDEX IF NOT EXISTS fsm_touched ON fsm (touched);
+"""
+
+class SqliteStorage(BaseStorage):
+    def __init__(self, path, hot_size, ttl):
+        self.path = path
+        self.hot_size = hot_size
+        self.ttl = ttl
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self.hot = OrderedDict()
+        self.dirty = {}
+        self.db = None
+        self.db_lock = asyncio.Lock()
+        self.task = None
+        self.live = 0
+        self.stats = Counter()
+
+    def connect(self):
+        if self.db is None:
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.executescript(FSM_SCHEMA)
+        return self.db
+
+    def db_load(self, key):
+        return self.connect().execute("SELECT state, data, touched FROM fsm WHERE key = ?", (key,)).fetchone()
+
+    def db_write(self, rows, cutoff=None):
+        db = self.connect()
+        with db:
+            db.executemany("INSERT OR REPLACE INTO fsm VALUES (?, ?, ?, ?)", [r for r in rows if r[1] is not None or r[2] != "{}"])
+            db.executemany("DELETE FROM fsm WHERE key = ?", [(r[0],) for r in rows if r[1] is None and r[2] == "{}"])
+            if cutoff is not None:
+                db.execute("DELETE FROM fsm WHERE touched < ?", (cutoff,))
+        if cutoff is not None:
+            return db.execute("SELECT COUNT(*) FROM fsm WHERE state IS NOT NULL").fetchone()[0]
+
+    async def record(self, key):
+        k = self.key_builder.build(key)
+        rec = self.hot.get(k) or self.dirty.get(k)
+        if rec is None:
+            self.stats["misses"] += 1
+            async with self.db_lock:
+                row = await asyncio.to_thread(self.db_load, k)
+            rec = self.hot.get(k) or self.dirty.get(k)
+            if rec is None:
+                rec = FsmRecord()
+                if row and row[2] > time.time() - self.ttl:
+                    rec = FsmRecord(row[0], json.loads(row[1]), row[2])
+        else:
+            self.stats["hits"] += 1
+        self.hot[k] = rec
+        self.hot.move_to_end(k)
+        while len(self.hot) > self.hot_size:
+            self.hot.popitem(last=False)
+        return k, rec
+
+    def touch(self, k, rec):
+        rec.touched = time.time()
+        self.dirty[k] = rec
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.flush_loop())
+
+    async def set_state(self, key, state=None):
+        k, rec = await self.record(key)
+        rec.state = state.state if isinstance(state, State) else state
+        self.touch(k, rec)
+
+    async def get_state(self, key):
+        return (await self.record(key))[1].state
+
+    async def set_data(self, key, data):
+        k, rec = await self.record(key)
+        rec.data = dict(data)
+        self.touch(k, rec)
+
+    async def get_data(self, key):
+        return (await self.record(key))[1].data.copy()
+
+    async def flush(self, sweep=False):
+        cutoff = None
+        if sweep:
+            cutoff = time.time() - self.ttl
+            for k in [k for k, rec in self.hot.items() if rec.touched and rec.touched < cutoff]:
+                del self.hot[k]
+        rows = [(k, rec.state, json.dumps(rec.data, ensure_ascii=False), rec.touched) for k, rec in self.dirty.items()]
+        self.dirty.clear()
+        if rows or sweep:
+            async with self.db_lock:
+                live = await asyncio.to_thread(self.db_write, rows, cutoff)
+            if sweep:
+                self.live = live
+
+    async def flush_loop(self):
+        next_sweep = 0
+        while True:
+            await asyncio.sleep(FSM_FLUSH_INTERVAL)
+            sweep = time.monotonic() >= next_sweep
+            if sweep:
+                next_sweep = time.monotonic() + FSM_SWEEP_INTERVAL
+            try:
+                await self.flush(sweep)
+            except Exception as e:
+                print(f"❌ FSM: {e}")
+
+    def footprint(self):
+        return sum(len(json.dumps(rec.data, ensure_ascii=False)) for rec in self.hot.values())
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        await self.flush()
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+fsm_storage = SqliteStorage(FSM_FILE, FSM_HOT_SIZE, FSM_TTL)
+dp = Dispatcher(storage=fsm_storage)
+# aiogram closes the storage as its first shutdown handler, before on_shutdown has
+# waited for running updates; on_shutdown closes it once, after the drain
+dp.shutdown.handlers = [h for h in dp.shutdown.handlers if h.callback != dp.fsm.close]
+dp.update.outer_middleware(UpdateMetrics())
+dp.message.middleware(HandlerMetrics())
+dp.callback_query.middleware(HandlerMetrics())
+
+# MEDIA
+# Files that have to be re-uploaded (e.g. chat photos) are streamed into memory,
+# capped at MEDIA_MAX_BYTES, and kept by file_unique_id so setting the same
+# picture on several channels downloads it once.
+media_cache = TTLCache(MEDIA_CACHE_TTL, MEDIA_CACHE_SIZE)
+
+async def download_bytes(file_id):
+    file = await bot.get_file(file_id)
+    if (file.file_size or 0) > MEDIA_MAX_BYTES:
+        raise ValueError(f"Fayl juda katta (> {MEDIA_MAX_BYTES // 1024} KB)")
+    if bot.session.api.is_local:
+        with open(file.file_path, "rb") as f:
+            data = f.read(MEDIA_MAX_BYTES + 1)
+    else:
+        buf = bytearray()
+        async for chunk in bot.session.stream_content(url=bot.session.api.file_url(bot.token, file.file_path), timeout=60):
+            buf += chunk
+            if len(buf) > MEDIA_MAX_BYTES:
+                break
+        data = bytes(buf)
+    if len(data) > MEDIA_MAX_BYTES:
+        raise ValueError(f"Fayl juda katta (> {MEDIA_MAX_BYTES // 1024} KB)")
+    return data
+
+async def fetch_media(media):
+    if (media.file_size or 0) > MEDIA_MAX_BYTES:
+        raise ValueError(f"Fayl juda katta (> {MEDIA_MAX_BYTES // 1024} KB)")
+    return await media_cache.get(media.file_unique_id, lambda: download_bytes(media.file_id))
 
 # STATES
 class ChannelStates(StatesGroup):
@@ -54,106 +1180,411 @@ class ChannelStates(StatesGroup):
     waiting_for_promote_user = State()
     waiting_for_pin_message = State()
     waiting_for_chat_photo = State()
+    waiting_for_bulk_ids = State()
+    waiting_for_schedule = State()
+    waiting_for_relay = State()
 
 # LOG
-def write_log(user_id, username, action, details=""):
+# write_log only queues the record; log_loop writes batches from a worker thread
+# into LOG_DB (SQLite). /logs queries it through indexes that end in the row id,
+# so "last N matching" costs the same however long the history is.
+log_queue = deque(maxlen=LOG_QUEUE_MAX)
+log_lock = asyncio.Lock()
+log_wakeup = asyncio.Event()
+log_db = None
+
+LOG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS log (id INTEGER PRIMARY KEY, ts INTEGER, user_id INTEGER, username TEXT, action TEXT, chat_id INTEGER, details TEXT);
+CREATE INDEX IF NOT EXISTS log_ts ON log (ts);
+CREATE INDEX IF NOT EXISTS log_user ON log (user_id, id);
+CREATE INDEX IF NOT EXISTS log_action ON log (action, id);
+CREATE INDEX IF NOT EXISTS log_chat ON log (chat_id, id);
+"""
+LOG_LINE = re.compile(r"^\[(.+?)\] (-?\d+) \(@(.*?)\) \| (.*?) \| (.*)$")
+LOG_FILTERS = {"user": ("user_id", "="), "chat": ("chat_id", "="), "action": ("action", "="), "from": ("ts", ">="), "to": ("ts", "<")}
+LOG_HELP = "/logs [N] [user=ID] [chat=ID] [action=NOM] [since=24h] [from=YYYY-MM-DD] [to=YYYY-MM-DD]"
+
+def format_log(row):
+    ts, user_id, username, action, details = row
+    return f"[{datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S')}] {user_id} (@{username}) | {action} | {details}\n"
+
+def import_legacy_logs(db):
+    # logs.txt and its rotated copies from before LOG_DB, oldest first
+    for path in [f"{LOG_FILE}.{i}{ext}" for i in range(99, 0, -1) for ext in (".gz", "")] + [LOG_FILE]:
+        if not os.path.exists(path):
+            continue
+        with (gzip.open if path.endswith(".gz") else open)(path, "rt", encoding="utf-8", errors="replace") as f:
+            rows = []
+            for line in f:
+                m = LOG_LINE.match(line.rstrip("\n"))
+                if m:
+                    ts = int(datetime.strptime(m[1], "%Y-%m-%d %H:%M:%S").timestamp())
+                    rows.append((ts, int(m[2]), m[3], m[4], None, m[5]))
+        with db:
+            db.executemany("INSERT INTO log (ts, user_id, username, action, chat_id, details) VALUES (?, ?, ?, ?, ?, ?)", rows)
+        os.replace(path, path + ".imported")
+
+def log_connect():
+    global log_db
+    if log_db is None:
+        log_db = sqlite3.connect(LOG_DB, check_same_thread=False)
+        log_db.execute("PRAGMA journal_mode=WAL")
+        log_db.executescript(LOG_SCHEMA)
+        import_legacy_logs(log_db)
+    return log_db
+
+def write_log_batch(records, cutoff=None):
+    db = log_connect()
+    with db:
+        db.executemany("INSERT INTO log (ts, user_id, username, action, chat_id, details) VALUES (:ts, :user_id, :username, :action, :chat_id, :details)", records)
+        if cutoff:
+            db.execute("DELETE FROM log WHERE ts < ?", (cutoff,))
+
+async def flush_logs(cutoff=None):
+    async with log_lock:
+        while log_queue or cutoff:
+            batch = [log_queue.popleft() for _ in range(min(len(log_queue), LOG_BATCH))]
+            try:
+                await asyncio.to_thread(write_log_batch, batch, cutoff)
+            except Exception:
+                log_queue.extendleft(reversed(batch))
+                raise
+            cutoff = None
+
+async def log_loop():
+    pruned = 0
+    while True:
+        try:
+            await asyncio.wait_for(log_wakeup.wait(), LOG_FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        log_wakeup.clear()
+        cutoff = None
+        if LOG_RETENTION_DAYS and time.time() - pruned > 3600:
+            pruned = time.time()
+            cutoff = int(pruned) - LOG_RETENTION_DAYS * 86400
+        try:
+            await flush_logs(cutoff)
+        except Exception as e:
+            print(f"❌ Log: {e}")
+
+def write_log(user_id, username, action, details="", chat_id=None):
+    log_queue.append({"ts": int(time.time()), "user_id": user_id, "username": username, "action": action, "chat_id": chat_id, "details": details})
+    if len(log_queue) >= LOG_BATCH:
+        log_wakeup.set()
+    notify_admin(user_id, action, details)
+
+def parse_log_query(args):
+    q = {"tail": LOG_TAIL}
+    for arg in args:
+        key, _, value = arg.partition("=")
+        if not value and key.isdigit():
+            key, value = "tail", key
+        try:
+            if key == "tail":
+                q["tail"] = max(1, min(int(value), LOG_QUERY_MAX))
+            elif key in ("user", "chat"):
+                q[key] = int(value)
+            elif key == "action":
+                q[key] = value.upper()
+            elif key == "since":
+                q["from"] = int(time.time()) - int(value[:-1]) * SCHEDULE_UNITS[value[-1]]
+            elif key in ("from", "to"):
+                q[key] = int(datetime.strptime(value, "%Y-%m-%dT%H:%M" if "T" in value else "%Y-%m-%d").timestamp())
+            else:
+                raise ValueError
+        except (ValueError, KeyError, IndexError):
+            raise ValueError(f"{arg}?\n\n{LOG_HELP}")
+    return q
+
+def query_logs(paths, q):
+    where = [f"{col} {op} ?" for key, (col, op) in LOG_FILTERS.items() if key in q]
+    params = [q[key] for key in LOG_FILTERS if key in q] + [q["tail"]]
+    sql = ("SELECT * FROM (SELECT ts, id, user_id, username, action, details FROM log"
+           + (" WHERE " + " AND ".join(where) if where else "") + " ORDER BY id DESC LIMIT ?) ORDER BY ts, id")
+    dbs = [sqlite3.connect(f"file:{path}?mode=ro", uri=True) for path in paths if os.path.exists(path)]
     try:
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        with open(LOG_FILE, "a", encoding="utf-8") as f:
-            f.write(f"[{timestamp}] {user_id} (@{username}) | {action} | {details}\n")
-        asyncio.create_task(bot.send_message(ADMIN_ID, f"📋 {action}\n👤 {user_id}\n{details[:50]}"))
-    except:
-        pass
+        # every shard returns its own last N; merged by time, the last N overall remain
+        rows = deque(heapq.merge(*(db.execute(sql, params) for db in dbs)), maxlen=q["tail"])
+    finally:
+        for db in dbs:
+            db.close()
+    data = "".join(format_log((ts, *rest)) for ts, _, *rest in rows).encode("utf-8")
+    if len(data) > LOG_GZIP_OVER:
+        return gzip.compress(data), "logs.txt.gz", len(rows)
+    return data, "logs.txt", len(rows)
+
+async def send_logs(chat_id, paths, q):
+    data, name, count = await asyncio.to_thread(query_logs, paths, q)
+    if not count:
+        await bot.send_message(chat_id, "❌ Yo'q")
+        return
+    await bot.send_document(chat_id, BufferedInputFile(data, filename=name), caption=f"📋 <b>Logs</b>: {count}", parse_mode="HTML")
+
+# ADMIN NOTIFY
+# NOTIFY_IMMEDIATE actions go out at once (coalesced into one message), the rest
+# are counted into a digest every NOTIFY_INTERVAL seconds. Only notify_loop sends.
+notify_counts = Counter()
+notify_recent = deque(maxlen=NOTIFY_LAST)
+notify_urgent = deque(maxlen=50)
+notify_wakeup = asyncio.Event()
+
+def notify_admin(user_id, action, details=""):
+    if action in NOTIFY_MUTED:
+        return
+    if action in NOTIFY_IMMEDIATE and len(notify_urgent) < notify_urgent.maxlen:
+        notify_urgent.append(f"📋 {action}\n👤 {user_id}\n{details[:50]}")
+        notify_wakeup.set()
+        return
+    notify_counts[action] += 1
+    notify_recent.append(f"{action} | {user_id} | {details[:50]}")
+
+async def flush_notifications(digest=True):
+    while notify_urgent:
+        lines = [notify_urgent.popleft()]
+        while notify_urgent and sum(len(l) for l in lines) < 3500:
+            lines.append(notify_urgent.popleft())
+        await bot.send_message(ADMIN_ID, "\n\n".join(lines))
+    if digest and notify_counts:
+        counts = "\n".join(f"{action}: {n}" for action, n in notify_counts.most_common())
+        recent = "\n".join(notify_recent)
+        notify_counts.clear()
+        notify_recent.clear()
+        await bot.send_message(ADMIN_ID, f"📋 Hisobot\n\n{counts}\n\n🕘 Oxirgilari:\n{recent}"[:4096])
+
+async def notify_loop():
+    loop = asyncio.get_running_loop()
+    next_digest = loop.time() + NOTIFY_INTERVAL
+    while True:
+        try:
+            await asyncio.wait_for(notify_wakeup.wait(), max(0, next_digest - loop.time()))
+        except asyncio.TimeoutError:
+            pass
+        notify_wakeup.clear()
+        digest = loop.time() >= next_digest
+        if digest:
+            next_digest = loop.time() + NOTIFY_INTERVAL
+        try:
+            await flush_notifications(digest)
+        except Exception as e:
+            print(f"❌ Notify: {e}")
+
+# CALLBACKS
+# Callback data is "1:action:field:..." built by cbd(). One aiogram handler looks
+# the action up in CALLBACKS and parses its fields once into the types declared
+# with @callback, so routing is a dict lookup however many actions there are.
+# Buttons sent before the codec (version 0, "sel_123") go through legacy_parts.
+CB_VERSION = "1"
+CALLBACKS = {}
+LEGACY_CALLBACKS = {"ball": "bsel:all", "bnone": "bsel:none", "btxt": "bsend:txt", "bpho": "bsend:pho",
+                    "bmed": "bsend:med", "bpol": "bsend:pol", "bsch": "sch"}
+
+def cbd(action, *fields):
+    return ":".join((CB_VERSION, action, *map(str, fields)))
+
+def callback(action, /, **fields):
+    def register(func):
+        params = inspect.signature(func).parameters
+        required = sum(1 for name in fields if params[name].default is inspect.Parameter.empty)
+        CALLBACKS[action] = (func, tuple(fields.items()), "state" in params, required)
+        return func
+    return register
+
+def chat_target(value):
+    # a chat id or "all"; anything else is rejected like a bad int field
+    return value if value == "all" else int(value)
+
+def legacy_parts(data):
+    if data in CALLBACKS:
+        return [data]
+    if data in LEGACY_CALLBACKS:
+        return LEGACY_CALLBACKS[data].split(":")
+    action, _, rest = data.partition("_")
+    if action == "btog":
+        return ["bsel", "tog", rest]
+    return [action] + rest.split("_") if rest else [action]
+
+def decode_callback(data):
+    version, sep, rest = data.partition(":")
+    parts = rest.split(":") if sep and version == CB_VERSION else legacy_parts(data)
+    route = CALLBACKS.get(parts[0])
+    if route is None or not route[3] <= len(parts) - 1 <= len(route[1]):
+        return None
+    try:
+        fields = {name: kind(value) for (name, kind), value in zip(route[1], parts[1:])}
+    except ValueError:
+        return None
+    return route[0], fields, route[2]
+
+@dp.callback_query()
+async def route_callback(cb: CallbackQuery, state: FSMContext, trace: dict = None):
+    route = decode_callback(cb.data or "")
+    if route is None:
+        await cb.answer("❌ Eskirgan tugma!", show_alert=True)
+        return
+    func, fields, wants_state = route
+    if trace is not None:
+        trace["handler"] = func.__name__
+    if wants_state:
+        fields["state"] = state
+    await func(cb, **fields)
 
 # KEYBOARDS
+# Markups are frozen pydantic models, so they are built once and shared. Per-index
+# menus are memoized; channel lists are cached per user until commit() bumps
+# that user's list_versions entry.
+list_versions = Counter()
+channel_list_cache = OrderedDict()
+
+@lru_cache(maxsize=None)
 def get_main_menu():
     return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="➕ Kanal qo'shish", callback_data="add_channel")],
-        [InlineKeyboardButton(text="📊 Kanallarim", callback_data="my_channels")],
-        [InlineKeyboardButton(text="❓ Yordam", callback_data="help")]
+        [InlineKeyboardButton(text="➕ Kanal qo'shish", callback_data=cbd("add_channel"))],
+        [InlineKeyboardButton(text="📊 Kanallarim", callback_data=cbd("my_channels"))],
+        [InlineKeyboardButton(text="❓ Yordam", callback_data=cbd("help"))]
     ])
 
 def get_channel_list(user_id):
+    cached = channel_list_cache.get(user_id)
+    if cached and cached[0] == list_versions[user_id]:
+        channel_list_cache.move_to_end(user_id)
+        return cached[1]
     kb = []
     if user_id in user_channels and user_channels[user_id]:
-        for idx, ch in enumerate(user_channels[user_id]):
-            emoji = "📢" if ch["type"] == "channel" else "👥"
-            kb.append([InlineKeyboardButton(text=f"{emoji} {ch['name'][:25]}", callback_data=f"sel_{idx}")])
-    kb.append([InlineKeyboardButton(text="🔙 Orqaga", callback_data="main")])
+        for ch in user_channels[user_id].values():
+            emoji = "⚠️" if ch.get("stale") else "📢" if ch["type"] == "channel" else "👥"
+            kb.append([InlineKeyboardButton(text=f"{emoji} {ch['name'][:25]}", callback_data=cbd("sel", ch['id']))])
+        kb.append([InlineKeyboardButton(text="📣 Hammasiga yuborish", callback_data=cbd("bcast"))])
+    kb.append([InlineKeyboardButton(text="🔙 Orqaga", callback_data=cbd("main"))])
+    markup = InlineKeyboardMarkup(inline_keyboard=kb)
+    channel_list_cache[user_id] = (list_versions[user_id], markup)
+    while len(channel_list_cache) > KEYBOARD_CACHE_SIZE:
+        channel_list_cache.popitem(last=False)
+    return markup
+
+@lru_cache(maxsize=KEYBOARD_CACHE_SIZE)
+def get_channel_menu(chat_id):
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="📊 Ma'lumot", callback_data=cbd("info", chat_id)),
+         InlineKeyboardButton(text="📤 Xabar", callback_data=cbd("send", chat_id))],
+        [InlineKeyboardButton(text="✏️ Nom", callback_data=cbd("title", chat_id)),
+         InlineKeyboardButton(text="📝 Tavsif", callback_data=cbd("desc", chat_id))],
+        [InlineKeyboardButton(text="🖼 Rasm", callback_data=cbd("pic", chat_id)),
+         InlineKeyboardButton(text="📌 Pin", callback_data=cbd("pin", chat_id))],
+        [InlineKeyboardButton(text="👥 A'zolar", callback_data=cbd("mem", chat_id)),
+         InlineKeyboardButton(text="🔗 Havola", callback_data=cbd("link", chat_id))],
+        [InlineKeyboardButton(text="🗑 O'chirish", callback_data=cbd("del", chat_id))],
+        [InlineKeyboardButton(text="🔙 Orqaga", callback_data=cbd("my_channels"))]
+    ])
+
+@lru_cache(maxsize=KEYBOARD_CACHE_SIZE)
+def get_send_menu(chat_id):
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="💬 Matn", callback_data=cbd("txt", chat_id)),
+         InlineKeyboardButton(text="📸 Rasm", callback_data=cbd("pho", chat_id))],
+        [InlineKeyboardButton(text="🖼 Media", callback_data=cbd("med", chat_id)),
+         InlineKeyboardButton(text="📊 Poll", callback_data=cbd("pol", chat_id))],
+        [InlineKeyboardButton(text="📨 Nusxa", callback_data=cbd("rel", chat_id)),
+         InlineKeyboardButton(text="⏰ Rejalashtirish", callback_data=cbd("sch", chat_id))],
+        [InlineKeyboardButton(text="🔙 Orqaga", callback_data=cbd("sel", chat_id))]
+    ])
+
+def get_bcast_menu(user_id, selected):
+    kb = []
+    for ch in user_channels.get(user_id, {}).values():
+        mark = "✅" if ch["id"] in selected else "⬜"
+        kb.append([InlineKeyboardButton(text=f"{mark} {ch['name'][:25]}", callback_data=cbd("bsel", "tog", ch['id']))])
+    kb.append([InlineKeyboardButton(text="✅ Hammasi", callback_data=cbd("bsel", "all")),
+               InlineKeyboardButton(text="⬜ Hech biri", callback_data=cbd("bsel", "none"))])
+    kb.append([InlineKeyboardButton(text="📤 Davom etish", callback_data=cbd("bgo"))])
+    kb.append([InlineKeyboardButton(text="🔙 Orqaga", callback_data=cbd("my_channels"))])
     return InlineKeyboardMarkup(inline_keyboard=kb)
 
-def get_channel_menu(idx):
+@lru_cache(maxsize=None)
+def get_bcast_send_menu():
     return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="📊 Ma'lumot", callback_data=f"info_{idx}"),
-         InlineKeyboardButton(text="📤 Xabar", callback_data=f"send_{idx}")],
-        [InlineKeyboardButton(text="✏️ Nom", callback_data=f"title_{idx}"),
-         InlineKeyboardButton(text="📝 Tavsif", callback_data=f"desc_{idx}")],
-        [InlineKeyboardButton(text="🖼 Rasm", callback_data=f"pic_{idx}"),
-         InlineKeyboardButton(text="📌 Pin", callback_data=f"pin_{idx}")],
-        [InlineKeyboardButton(text="👥 A'zolar", callback_data=f"mem_{idx}"),
-         InlineKeyboardButton(text="🔗 Havola", callback_data=f"link_{idx}")],
-        [InlineKeyboardButton(text="🗑 O'chirish", callback_data=f"del_{idx}")],
-        [InlineKeyboardButton(text="🔙 Orqaga", callback_data="my_channels")]
+        [InlineKeyboardButton(text="💬 Matn", callback_data=cbd("bsend", "txt")),
+         InlineKeyboardButton(text="📸 Rasm", callback_data=cbd("bsend", "pho"))],
+        [InlineKeyboardButton(text="🖼 Media", callback_data=cbd("bsend", "med")),
+         InlineKeyboardButton(text="📊 Poll", callback_data=cbd("bsend", "pol"))],
+        [InlineKeyboardButton(text="📨 Nusxa", callback_data=cbd("bsend", "rel")),
+         InlineKeyboardButton(text="⏰ Rejalashtirish", callback_data=cbd("sch"))],
+        [InlineKeyboardButton(text="🔙 Orqaga", callback_data=cbd("bsel"))]
     ])
 
-def get_send_menu(idx):
+@lru_cache(maxsize=KEYBOARD_CACHE_SIZE)
+def get_member_menu(chat_id):
     return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="💬 Matn", callback_data=f"txt_{idx}"),
-         InlineKeyboardButton(text="📸 Rasm", callback_data=f"pho_{idx}")],
-        [InlineKeyboardButton(text="🖼 Media", callback_data=f"med_{idx}"),
-         InlineKeyboardButton(text="📊 Poll", callback_data=f"pol_{idx}")],
-        [InlineKeyboardButton(text="🔙 Orqaga", callback_data=f"sel_{idx}")]
+        [InlineKeyboardButton(text="🚫 Ban", callback_data=cbd("ban", chat_id)),
+         InlineKeyboardButton(text="✅ Unban", callback_data=cbd("unb", chat_id))],
+        [InlineKeyboardButton(text="⚠️ Restrict", callback_data=cbd("res", chat_id)),
+         InlineKeyboardButton(text="⭐️ Promote", callback_data=cbd("pro", chat_id))],
+        [InlineKeyboardButton(text="📋 Ommaviy", callback_data=cbd("bulk", chat_id))],
+        [InlineKeyboardButton(text="🔙 Orqaga", callback_data=cbd("sel", chat_id))]
     ])
 
-def get_member_menu(idx):
+@lru_cache(maxsize=KEYBOARD_CACHE_SIZE)
+def get_bulk_menu(chat_id):
     return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🚫 Ban", callback_data=f"ban_{idx}"),
-         InlineKeyboardButton(text="✅ Unban", callback_data=f"unb_{idx}")],
-        [InlineKeyboardButton(text="⚠️ Restrict", callback_data=f"res_{idx}"),
-         InlineKeyboardButton(text="⭐️ Promote", callback_data=f"pro_{idx}")],
-        [InlineKeyboardButton(text="🔙 Orqaga", callback_data=f"sel_{idx}")]
+        [InlineKeyboardButton(text="🚫 Ban", callback_data=cbd("bmod", "ban", chat_id)),
+         InlineKeyboardButton(text="✅ Unban", callback_data=cbd("bmod", "unb", chat_id)),
+         InlineKeyboardButton(text="⚠️ Restrict", callback_data=cbd("bmod", "res", chat_id))],
+        [InlineKeyboardButton(text="🚫 Ban (hammasi)", callback_data=cbd("bmod", "ban", "all")),
+         InlineKeyboardButton(text="✅ Unban (hammasi)", callback_data=cbd("bmod", "unb", "all")),
+         InlineKeyboardButton(text="⚠️ Restrict (hammasi)", callback_data=cbd("bmod", "res", "all"))],
+        [InlineKeyboardButton(text="🔙 Orqaga", callback_data=cbd("mem", chat_id))]
     ])
 
-def get_pin_menu(idx):
+@lru_cache(maxsize=KEYBOARD_CACHE_SIZE)
+def get_pin_menu(chat_id):
     return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="📌 Pin", callback_data=f"dopin_{idx}"),
-         InlineKeyboardButton(text="📍 Unpin", callback_data=f"unpin_{idx}")],
-        [InlineKeyboardButton(text="🚫 Unpin All", callback_data=f"unpinall_{idx}")],
-        [InlineKeyboardButton(text="🔙 Orqaga", callback_data=f"sel_{idx}")]
+        [InlineKeyboardButton(text="📌 Pin", callback_data=cbd("dopin", chat_id)),
+         InlineKeyboardButton(text="📍 Unpin", callback_data=cbd("unpin", chat_id))],
+        [InlineKeyboardButton(text="🚫 Unpin All", callback_data=cbd("unpinall", chat_id))],
+        [InlineKeyboardButton(text="🔙 Orqaga", callback_data=cbd("sel", chat_id))]
     ])
 
-def get_pic_menu(idx):
+@lru_cache(maxsize=KEYBOARD_CACHE_SIZE)
+def get_pic_menu(chat_id):
     return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🖼 O'rnatish", callback_data=f"setpic_{idx}"),
-         InlineKeyboardButton(text="🗑 O'chirish", callback_data=f"delpic_{idx}")],
-        [InlineKeyboardButton(text="🔙 Orqaga", callback_data=f"sel_{idx}")]
+        [InlineKeyboardButton(text="🖼 O'rnatish", callback_data=cbd("setpic", chat_id)),
+         InlineKeyboardButton(text="🗑 O'chirish", callback_data=cbd("delpic", chat_id))],
+        [InlineKeyboardButton(text="🔙 Orqaga", callback_data=cbd("sel", chat_id))]
     ])
 
-def get_link_menu(idx):
+@lru_cache(maxsize=KEYBOARD_CACHE_SIZE)
+def get_link_menu(chat_id):
     return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🔗 Doimiy", callback_data=f"explink_{idx}"),
-         InlineKeyboardButton(text="⏰ Cheklangan", callback_data=f"crtlink_{idx}")],
-        [InlineKeyboardButton(text="🔙 Orqaga", callback_data=f"sel_{idx}")]
+        [InlineKeyboardButton(text="🔗 Doimiy", callback_data=cbd("explink", chat_id)),
+         InlineKeyboardButton(text="⏰ Cheklangan", callback_data=cbd("crtlink", chat_id))],
+        [InlineKeyboardButton(text="🔙 Orqaga", callback_data=cbd("sel", chat_id))]
     ])
 
+STATIC_MENUS = (get_channel_menu, get_send_menu, get_member_menu, get_bulk_menu, get_pin_menu, get_pic_menu, get_link_menu)
+
+def warm_keyboards():
+    for chat_id in itertools.islice(chat_owners, KEYBOARD_CACHE_SIZE):
+        for menu in STATIC_MENUS:
+            menu(chat_id)
+
 # START
 @dp.message(Command("start"))
 async def start_cmd(msg: Message):
     write_log(msg.from_user.id, msg.from_user.username or "noname", "START", "")
     await msg.answer("🤖 <b>Telegram Kanal Bot</b>\n\nKanallaringizni boshqaring!", parse_mode="HTML", reply_markup=get_main_menu())
 
-@dp.callback_query(F.data == "main")
+@callback("main")
 async def main_cb(cb: CallbackQuery):
     await cb.message.edit_text("🤖 <b>Asosiy menyu</b>", parse_mode="HTML", reply_markup=get_main_menu())
     await cb.answer()
 
-@dp.callback_query(F.data == "help")
+@callback("help")
 async def help_cb(cb: CallbackQuery):
-    await cb.message.edit_text("❓ <b>YORDAM</b>\n\n1. Kanal qo'shing\n2. Bot admin qiling\n3. Boshqaring!\n\n<b>Admin:</b> /stats /logs /backup", parse_mode="HTML", reply_markup=InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="🔙 Orqaga", callback_data="main")]]))
+    await cb.message.edit_text("❓ <b>YORDAM</b>\n\n1. Kanal qo'shing\n2. Bot admin qiling\n3. Boshqaring!\n\n<b>Admin:</b> /stats /logs /backup", parse_mode="HTML", reply_markup=InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="🔙 Orqaga", callback_data=cbd("main"))]]))
     await cb.answer()
 
 # ADD CHANNEL
-@dp.callback_query(F.data == "add_channel")
+@callback("add_channel")
 async def add_ch_cb(cb: CallbackQuery, state: FSMContext):
     await cb.message.edit_text("📝 <b>Kanal ID/username:</b>\n\n<code>-1001234567890</code>\n<code>@channel</code>", parse_mode="HTML")
     await state.set_state(ChannelStates.waiting_for_channel_id)
@@ -162,8 +1593,10 @@ async def add_ch_cb(cb: CallbackQuery, state: FSMContext):
 @dp.message(ChannelStates.waiting_for_channel_id)
 async def add_ch_proc(msg: Message, state: FSMContext):
     ch_id = msg.text.strip()
+    if re.fullmatch(r"-?\d+", ch_id, re.ASCII):
+        ch_id = int(ch_id)
     try:
-        chat = await bot.get_chat(chat_id=ch_id)
+        chat = await cached_chat(ch_id)
         bot_mem = await bot.get_chat_member(chat_id=chat.id, user_id=bot.id)
         if bot_mem.status not in ["administrator", "creator"]:
             await msg.answer("❌ Bot admin emas!", reply_markup=get_main_menu())
@@ -171,78 +1604,74 @@ async def add_ch_proc(msg: Message, state: FSMContext):
             return
         
         uid = msg.from_user.id
-        if uid not in user_channels:
-            user_channels[uid] = []
-        
-        if any(c["id"] == chat.id for c in user_channels[uid]):
+        ch = user_channels.get(uid, {}).get(chat.id)
+        if ch:
+            if ch.get("stale"):
+                # re-adding after restoring admin rights clears the health mark
+                commit({"op": "meta", "uid": uid, "id": chat.id, "name": chat.title, "username": chat.username, "stale": None})
             await msg.answer("⚠️ Allaqachon qo'shilgan!", reply_markup=get_main_menu())
             await state.clear()
             return
         
-        user_channels[uid].append({"id": chat.id, "username": chat.username, "name": chat.title, "type": chat.type, "added": datetime.now().strftime("%Y-%m-%d %H:%M")})
-        save_data(user_channels)
-        write_log(uid, msg.from_user.username or "noname", "ADDED", chat.title)
+        commit({"op": "add", "uid": uid, "ch": {"id": chat.id, "username": chat.username, "name": chat.title, "type": chat.type, "added": datetime.now().strftime("%Y-%m-%d %H:%M")}})
+        write_log(uid, msg.from_user.username or "noname", "ADDED", chat.title, chat_id=chat.id)
         await msg.answer(f"✅ <b>Qo'shildi!</b>\n\n📢 {chat.title}\n🆔 <code>{chat.id}</code>", parse_mode="HTML", reply_markup=get_main_menu())
     except Exception as e:
         await msg.answer(f"❌ {str(e)[:100]}", reply_markup=get_main_menu())
     await state.clear()
 
 # MY CHANNELS
-@dp.callback_query(F.data == "my_channels")
+@callback("my_channels")
 async def my_ch_cb(cb: CallbackQuery):
     uid = cb.from_user.id
     if uid not in user_channels or not user_channels[uid]:
-        await cb.message.edit_text("📭 <b>Kanal yo'q!</b>", parse_mode="HTML", reply_markup=InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="➕ Qo'shish", callback_data="add_channel")],[InlineKeyboardButton(text="🔙 Orqaga", callback_data="main")]]))
+        await cb.message.edit_text("📭 <b>Kanal yo'q!</b>", parse_mode="HTML", reply_markup=InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="➕ Qo'shish", callback_data=cbd("add_channel"))],[InlineKeyboardButton(text="🔙 Orqaga", callback_data=cbd("main"))]]))
     else:
         await cb.message.edit_text(f"📊 <b>Kanallar ({len(user_channels[uid])} ta)</b>", parse_mode="HTML", reply_markup=get_channel_list(uid))
     await cb.answer()
 
-@dp.callback_query(F.data.startswith("sel_"))
-async def sel_ch_cb(cb: CallbackQuery):
-    idx = int(cb.data.split("_")[1])
+@callback("sel", chat_id=int)
+async def sel_ch_cb(cb: CallbackQuery, chat_id: int):
     uid = cb.from_user.id
-    if uid not in user_channels or idx >= len(user_channels[uid]):
+    ch = user_channels.get(uid, {}).get(chat_id)
+    if not ch:
         await cb.answer("❌ Topilmadi!", show_alert=True)
         return
-    ch = user_channels[uid][idx]
     emoji = "📢" if ch["type"] == "channel" else "👥"
-    await cb.message.edit_text(f"{emoji} <b>{ch['name']}</b>\n\n🆔 <code>{ch['id']}</code>\n📅 {ch['added']}", parse_mode="HTML", reply_markup=get_channel_menu(idx))
+    stale = f"\n\n{STALE_TEXT[ch['stale']]}" if ch.get("stale") else ""
+    await cb.message.edit_text(f"{emoji} <b>{ch['name']}</b>\n\n🆔 <code>{ch['id']}</code>\n📅 {ch['added']}{stale}", parse_mode="HTML", reply_markup=get_channel_menu(chat_id))
     await cb.answer()
 
-@dp.callback_query(F.data.startswith("del_"))
-async def del_ch_cb(cb: CallbackQuery):
-    idx = int(cb.data.split("_")[1])
+@callback("del", chat_id=int)
+async def del_ch_cb(cb: CallbackQuery, chat_id: int):
     uid = cb.from_user.id
-    if uid not in user_channels or idx >= len(user_channels[uid]):
+    ch = user_channels.get(uid, {}).get(chat_id)
+    if not ch:
         await cb.answer("❌ Topilmadi!", show_alert=True)
         return
-    ch = user_channels[uid].pop(idx)
-    save_data(user_channels)
-    write_log(uid, cb.from_user.username or "noname", "DELETED", ch['name'])
+    commit({"op": "del", "uid": uid, "id": ch["id"]})
+    write_log(uid, cb.from_user.username or "noname", "DELETED", ch['name'], chat_id=ch["id"])
     await cb.message.edit_text(f"✅ <b>O'chirildi!</b>\n\n📢 {ch['name']}", parse_mode="HTML", reply_markup=get_main_menu())
     await cb.answer()
 
-@dp.callback_query(F.data.startswith("info_"))
-async def info_cb(cb: CallbackQuery):
-    idx = int(cb.data.split("_")[1])
+@callback("info", chat_id=int)
+async def info_cb(cb: CallbackQuery, chat_id: int):
     uid = cb.from_user.id
-    if uid not in user_channels or idx >= len(user_channels[uid]):
+    ch = user_channels.get(uid, {}).get(chat_id)
+    if not ch:
         await cb.answer("❌ Topilmadi!", show_alert=True)
         return
-    ch = user_channels[uid][idx]
     try:
-        chat = await bot.get_chat(chat_id=ch["id"])
-        count = await bot.get_chat_member_count(chat_id=ch["id"])
-        await cb.message.edit_text(f"📊 <b>Ma'lumot</b>\n\n📝 {chat.title}\n🆔 <code>{chat.id}</code>\n📖 {chat.description or 'Yo`q'}\n👤 @{chat.username or 'Yo`q'}\n👥 {count:,}", parse_mode="HTML", reply_markup=InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="🔙 Orqaga", callback_data=f"sel_{idx}")]]))
+        chat, count = await asyncio.gather(cached_chat(ch["id"]), cached_member_count(ch["id"]))
+        await cb.message.edit_text(f"📊 <b>Ma'lumot</b>\n\n📝 {chat.title}\n🆔 <code>{chat.id}</code>\n📖 {chat.description or 'Yo`q'}\n👤 @{chat.username or 'Yo`q'}\n👥 {count:,}{format_growth(ch['id'])}", parse_mode="HTML", reply_markup=InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="🔙 Orqaga", callback_data=cbd("sel", chat_id))]]))
     except Exception as e:
         await cb.answer(f"❌ {str(e)[:50]}", show_alert=True)
     await cb.answer()
 
 # TITLE
-@dp.callback_query(F.data.startswith("title_"))
-async def title_cb(cb: CallbackQuery, state: FSMContext):
-    idx = int(cb.data.split("_")[1])
-    await state.update_data(idx=idx)
+@callback("title", chat_id=int)
+async def title_cb(cb: CallbackQuery, chat_id: int, state: FSMContext):
+    await state.update_data(chat_id=chat_id)
     await state.set_state(ChannelStates.waiting_for_new_title)
     await cb.message.edit_text("✏️ <b>Yangi nom:</b>", parse_mode="HTML")
     await cb.answer()
@@ -250,28 +1679,26 @@ async def title_cb(cb: CallbackQuery, state: FSMContext):
 @dp.message(ChannelStates.waiting_for_new_title)
 async def title_proc(msg: Message, state: FSMContext):
     data = await state.get_data()
-    idx = data.get("idx")
     uid = msg.from_user.id
-    if uid not in user_channels or idx >= len(user_channels[uid]):
+    ch = user_channels.get(uid, {}).get(data.get("chat_id"))
+    if not ch:
         await msg.answer("❌ Topilmadi!", reply_markup=get_main_menu())
         await state.clear()
         return
-    ch = user_channels[uid][idx]
     try:
         await bot.set_chat_title(chat_id=ch["id"], title=msg.text.strip())
-        user_channels[uid][idx]["name"] = msg.text.strip()
-        save_data(user_channels)
-        write_log(uid, msg.from_user.username or "noname", "TITLE", msg.text.strip())
+        invalidate_chat(ch["id"])
+        commit({"op": "title", "uid": uid, "id": ch["id"], "name": msg.text.strip()})
+        write_log(uid, msg.from_user.username or "noname", "TITLE", msg.text.strip(), chat_id=ch["id"])
         await msg.answer("✅ <b>Nom o'zgartirildi!</b>", parse_mode="HTML", reply_markup=get_main_menu())
     except Exception as e:
         await msg.answer(f"❌ {str(e)[:100]}", reply_markup=get_main_menu())
     await state.clear()
 
 # DESCRIPTION
-@dp.callback_query(F.data.startswith("desc_"))
-async def desc_cb(cb: CallbackQuery, state: FSMContext):
-    idx = int(cb.data.split("_")[1])
-    await state.update_data(idx=idx)
+@callback("desc", chat_id=int)
+async def desc_cb(cb: CallbackQuery, chat_id: int, state: FSMContext):
+    await state.update_data(chat_id=chat_id)
     await state.set_state(ChannelStates.waiting_for_new_description)
     await cb.message.edit_text("📝 <b>Yangi tavsif:</b>", parse_mode="HTML")
     await cb.answer()
@@ -279,165 +1706,786 @@ async def desc_cb(cb: CallbackQuery, state: FSMContext):
 @dp.message(ChannelStates.waiting_for_new_description)
 async def desc_proc(msg: Message, state: FSMContext):
     data = await state.get_data()
-    idx = data.get("idx")
     uid = msg.from_user.id
-    if uid not in user_channels or idx >= len(user_channels[uid]):
+    ch = user_channels.get(uid, {}).get(data.get("chat_id"))
+    if not ch:
         await msg.answer("❌ Topilmadi!", reply_markup=get_main_menu())
         await state.clear()
         return
-    ch = user_channels[uid][idx]
     try:
         await bot.set_chat_description(chat_id=ch["id"], description=msg.text.strip())
-        write_log(uid, msg.from_user.username or "noname", "DESC", ch['name'])
+        invalidate_chat(ch["id"])
+        write_log(uid, msg.from_user.username or "noname", "DESC", ch['name'], chat_id=ch["id"])
         await msg.answer("✅ <b>Tavsif o'zgartirildi!</b>", parse_mode="HTML", reply_markup=get_main_menu())
     except Exception as e:
         await msg.answer(f"❌ {str(e)[:100]}", reply_markup=get_main_menu())
     await state.clear()
 
 # SEND MENU
-@dp.callback_query(F.data.startswith("send_"))
-async def send_cb(cb: CallbackQuery):
-    idx = int(cb.data.split("_")[1])
-    await cb.message.edit_text("📤 <b>Xabar yuborish</b>", parse_mode="HTML", reply_markup=get_send_menu(idx))
+@callback("send", chat_id=int)
+async def send_cb(cb: CallbackQuery, chat_id: int, state: FSMContext):
+    await state.clear()
+    await cb.message.edit_text("📤 <b>Xabar yuborish</b>", parse_mode="HTML", reply_markup=get_send_menu(chat_id))
     await cb.answer()
 
-@dp.callback_query(F.data.startswith("txt_"))
-async def txt_cb(cb: CallbackQuery, state: FSMContext):
-    idx = int(cb.data.split("_")[1])
-    await state.update_data(idx=idx)
+@callback("txt", chat_id=int)
+async def txt_cb(cb: CallbackQuery, chat_id: int, state: FSMContext):
+    await state.update_data(chat_id=chat_id)
     await state.set_state(ChannelStates.waiting_for_message)
     await cb.message.edit_text("💬 <b>Matn yuboring:</b>", parse_mode="HTML")
     await cb.answer()
 
 @dp.message(ChannelStates.waiting_for_message)
 async def txt_proc(msg: Message, state: FSMContext):
-    data = await state.get_data()
-    idx = data.get("idx")
-    uid = msg.from_user.id
-    if uid not in user_channels or idx >= len(user_channels[uid]):
-        await msg.answer("❌ Topilmadi!", reply_markup=get_main_menu())
-        await state.clear()
-        return
-    ch = user_channels[uid][idx]
-    try:
-        await bot.send_message(chat_id=ch["id"], text=msg.text, parse_mode="HTML")
-        write_log(uid, msg.from_user.username or "noname", "MSG_SENT", ch['name'])
-        await msg.answer("✅ <b>Yuborildi!</b>", parse_mode="HTML", reply_markup=get_main_menu())
-    except Exception as e:
-        await msg.answer(f"❌ {str(e)[:100]}", reply_markup=get_main_menu())
-    await state.clear()
+    await deliver(msg, state, {"kind": "text", "text": msg.text}, "MSG_SENT")
 
-@dp.callback_query(F.data.startswith("pho_"))
-async def pho_cb(cb: CallbackQuery, state: FSMContext):
-    idx = int(cb.data.split("_")[1])
-    await state.update_data(idx=idx)
+@callback("pho", chat_id=int)
+async def pho_cb(cb: CallbackQuery, chat_id: int, state: FSMContext):
+    await state.update_data(chat_id=chat_id)
     await state.set_state(ChannelStates.waiting_for_photo)
     await cb.message.edit_text("📸 <b>Rasm yuboring:</b>", parse_mode="HTML")
     await cb.answer()
 
 @dp.message(ChannelStates.waiting_for_photo, F.photo)
 async def pho_proc(msg: Message, state: FSMContext):
-    data = await state.get_data()
-    idx = data.get("idx")
-    uid = msg.from_user.id
-    if uid not in user_channels or idx >= len(user_channels[uid]):
-        await msg.answer("❌ Topilmadi!", reply_markup=get_main_menu())
-        await state.clear()
+    await deliver(msg, state, {"kind": "photo", "file_id": msg.photo[-1].file_id, "caption": msg.caption}, "PHOTO_SENT")
+
+# Album items are collected in memory, not in FSM data: a 10-item album arrives as
+# 10 updates at once, and each one only appends to album_buffers[uid]. The reply
+# is debounced, so the user gets one "✅ N ta" per album instead of one per item.
+# The relay mode collects message ids into the same buffers.
+album_buffers = {}
+
+def media_item(msg):
+    if msg.photo:
+        item = {"type": "photo", "file_id": msg.photo[-1].file_id, "caption": msg.caption}
+    elif msg.video:
+        item = {"type": "video", "file_id": msg.video.file_id, "caption": msg.caption}
+    else:
+        item = {"type": "document", "file_id": msg.document.file_id, "caption": msg.caption}
+    if msg.media_group_id:
+        item["group"] = msg.media_group_id
+    return item
+
+def reset_album(uid):
+    buf = album_buffers.pop(uid, None)
+    if buf and buf["timer"]:
+        buf["timer"].cancel()
+    return buf["items"] if buf else []
+
+async def album_ack(uid):
+    await asyncio.sleep(ALBUM_DEBOUNCE)
+    buf = album_buffers.get(uid)
+    if not buf:
         return
-    ch = user_channels[uid][idx]
+    buf["timer"] = None
     try:
-        await bot.send_photo(chat_id=ch["id"], photo=msg.photo[-1].file_id, caption=msg.caption, parse_mode="HTML")
-        write_log(uid, msg.from_user.username or "noname", "PHOTO_SENT", ch['name'])
-        await msg.answer("✅ <b>Yuborildi!</b>", parse_mode="HTML", reply_markup=get_main_menu())
+        await bot.send_message(buf["chat"], f"✅ {len(buf['items'])} ta\n\n/done")
     except Exception as e:
-        await msg.answer(f"❌ {str(e)[:100]}", reply_markup=get_main_menu())
-    await state.clear()
+        print(f"❌ Album: {e}")
 
-@dp.callback_query(F.data.startswith("med_"))
-async def med_cb(cb: CallbackQuery, state: FSMContext):
-    idx = int(cb.data.split("_")[1])
-    await state.update_data(idx=idx, media=[])
+@callback("med", chat_id=int)
+async def med_cb(cb: CallbackQuery, chat_id: int, state: FSMContext):
+    reset_album(cb.from_user.id)
+    await state.update_data(chat_id=chat_id)
     await state.set_state(ChannelStates.waiting_for_media_group)
-    await cb.message.edit_text("🖼 <b>Rasmlar yuboring</b>\n\n/done - tugadi", parse_mode="HTML")
+    await cb.message.edit_text("🖼 <b>Rasm, video yoki fayllar yuboring</b>\n\n/done - tugadi", parse_mode="HTML")
     await cb.answer()
 
-@dp.message(ChannelStates.waiting_for_media_group, F.photo)
-async def med_collect(msg: Message, state: FSMContext):
-    data = await state.get_data()
-    media = data.get("media", [])
-    media.append({"file_id": msg.photo[-1].file_id, "caption": msg.caption})
-    await state.update_data(media=media)
-    await msg.answer(f"✅ {len(media)} ta\n\n/done")
+async def collect(msg, item):
+    uid = msg.from_user.id
+    now = time.monotonic()
+    buf = album_buffers.get(uid)
+    if buf is None:
+        for old in [u for u, b in album_buffers.items() if now - b["touched"] > ALBUM_TTL]:
+            reset_album(old)
+        buf = album_buffers[uid] = {"items": [], "chat": msg.chat.id, "timer": None, "touched": now}
+    if len(buf["items"]) >= ALBUM_MAX_ITEMS:
+        await msg.answer(f"❌ Maksimum {ALBUM_MAX_ITEMS} ta!\n\n/done")
+        return
+    buf["items"].append(item)
+    buf["touched"] = now
+    if buf["timer"]:
+        buf["timer"].cancel()
+    buf["timer"] = asyncio.create_task(album_ack(uid))
+
+@dp.message(ChannelStates.waiting_for_media_group, F.photo | F.video | F.document)
+async def med_collect(msg: Message):
+    await collect(msg, media_item(msg))
 
 @dp.message(ChannelStates.waiting_for_media_group, Command("done"))
 async def med_done(msg: Message, state: FSMContext):
-    data = await state.get_data()
-    idx = data.get("idx")
-    media = data.get("media", [])
-    uid = msg.from_user.id
-    if not media or len(media) < 2:
+    buf = album_buffers.get(msg.from_user.id)
+    if not buf or len(buf["items"]) < 2:
         await msg.answer("❌ Kamida 2 ta!", reply_markup=get_main_menu())
         return
-    if uid not in user_channels or idx >= len(user_channels[uid]):
-        await msg.answer("❌ Topilmadi!", reply_markup=get_main_menu())
-        await state.clear()
+    media = reset_album(msg.from_user.id)
+    await deliver(msg, state, {"kind": "media", "media": media}, "MEDIA_SENT", f"{len(media)} media", f"✅ <b>Yuborildi!</b>\n\n🖼 {len(media)} ta")
+
+# Relay: whatever the user sends or forwards (any type, formatting intact) is
+# copied server-side with copy_messages, so nothing is downloaded or re-uploaded.
+RELAY_PROMPT = "📨 <b>Istalgan xabarlarni yuboring yoki forward qiling</b>\n\n/done - tugadi"
+
+@callback("rel", chat_id=int)
+async def rel_cb(cb: CallbackQuery, chat_id: int, state: FSMContext):
+    reset_album(cb.from_user.id)
+    await state.update_data(chat_id=chat_id)
+    await state.set_state(ChannelStates.waiting_for_relay)
+    await cb.message.edit_text(RELAY_PROMPT, parse_mode="HTML")
+    await cb.answer()
+
+@dp.message(ChannelStates.waiting_for_relay, Command("done"))
+async def rel_done(msg: Message, state: FSMContext):
+    buf = album_buffers.get(msg.from_user.id)
+    if not buf or not buf["items"]:
+        await msg.answer("❌ Xabar yo'q!", reply_markup=get_main_menu())
         return
-    ch = user_channels[uid][idx]
-    try:
-        group = []
-        for i, m in enumerate(media):
-            if i == 0:
-                group.append(InputMediaPhoto(media=m["file_id"], caption=m["caption"]))
-            else:
-                group.append(InputMediaPhoto(media=m["file_id"]))
-        await bot.send_media_group(chat_id=ch["id"], media=group)
-        write_log(uid, msg.from_user.username or "noname", "MEDIA_SENT", f"{len(media)} photos")
-        await msg.answer(f"✅ <b>Yuborildi!</b>\n\n🖼 {len(media)} ta", parse_mode="HTML", reply_markup=get_main_menu())
-    except Exception as e:
-        await msg.answer(f"❌ {str(e)[:100]}", reply_markup=get_main_menu())
-    await state.clear()
+    ids = sorted(reset_album(msg.from_user.id))
+    await deliver(msg, state, {"kind": "copy", "from_chat": msg.chat.id, "ids": ids}, "COPY_SENT", f"{len(ids)} xabar", f"✅ <b>Yuborildi!</b>\n\n📨 {len(ids)} ta")
+
+# commands (/jobs, /stats, ...) fall through to their own handlers instead of being relayed
+@dp.message(ChannelStates.waiting_for_relay, ~F.text.startswith("/"))
+async def rel_collect(msg: Message):
+    await collect(msg, msg.message_id)
 
-@dp.callback_query(F.data.startswith("pol_"))
-async def pol_cb(cb: CallbackQuery, state: FSMContext):
-    idx = int(cb.data.split("_")[1])
-    await state.update_data(idx=idx)
+@callback("pol", chat_id=int)
+async def pol_cb(cb: CallbackQuery, chat_id: int, state: FSMContext):
+    await state.update_data(chat_id=chat_id)
     await state.set_state(ChannelStates.waiting_for_poll)
     await cb.message.edit_text("📊 <b>Format:</b>\n\nSavol\nVariant1\nVariant2", parse_mode="HTML")
     await cb.answer()
 
 @dp.message(ChannelStates.waiting_for_poll)
 async def pol_proc(msg: Message, state: FSMContext):
+    lines = msg.text.strip().split("\n")
+    if len(lines) < 3:
+        await msg.answer("❌ Kamida savol va 2 variant!", reply_markup=get_main_menu())
+        return
+    await deliver(msg, state, {"kind": "poll", "question": lines[0], "options": [l.strip() for l in lines[1:] if l.strip()]}, "POLL_SENT")
+
+# POSTS
+# A composed post is a plain dict so the same payload can be sent to one channel,
+# fanned out to many, or retried later.
+# Albums are split into send_media_group calls of at most 10 items. Items of one
+# media_group_id stay together, in the place of the album's first item, and never
+# share a call with another album; files sent one by one are grouped among
+# themselves. Documents can't share an album with photos/videos, so each run of
+# one class is its own chunk, and a chunk of one is sent as a single message.
+# Relayed ids are copied in runs of COPY_BATCH (the copy_messages limit), in
+# ascending order as the API requires; albums stay grouped. A scheduled relay
+# needs the originals to still exist in the user's chat with the bot.
+COPY_BATCH = 100
+INPUT_MEDIA = {"photo": InputMediaPhoto, "video": InputMediaVideo, "document": InputMediaDocument}
+
+def album_chunks(items):
+    albums = {}
+    loose = 0
+    for m in items:
+        if m.get("group"):
+            loose += 1
+            albums.setdefault(m["group"], []).append(m)
+        else:
+            albums.setdefault(("loose", loose), []).append(m)
+    chunks = []
+    for album in albums.values():
+        runs = []
+        for m in album:
+            kind = "document" if m.get("type") == "document" else "visual"
+            if runs and runs[-1][0] == kind and len(runs[-1][1]) < 10:
+                runs[-1][1].append(m)
+            else:
+                runs.append((kind, [m]))
+        chunks.extend(chunk for _, chunk in runs)
+    return chunks
+
+async def send_single(chat_id, m):
+    kind = m.get("type", "photo")
+    if kind == "video":
+        return await bot.send_video(chat_id=chat_id, video=m["file_id"], caption=m["caption"])
+    if kind == "document":
+        return await bot.send_document(chat_id=chat_id, document=m["file_id"], caption=m["caption"])
+    return await bot.send_photo(chat_id=chat_id, photo=m["file_id"], caption=m["caption"])
+
+async def send_post(chat_id, post):
+    if post["kind"] == "text":
+        return await bot.send_message(chat_id=chat_id, text=post["text"], parse_mode="HTML")
+    if post["kind"] == "photo":
+        return await bot.send_photo(chat_id=chat_id, photo=post["file_id"], caption=post["caption"], parse_mode="HTML")
+    if post["kind"] == "media":
+        sent = []
+        for chunk in album_chunks(post["media"]):
+            if len(chunk) == 1:
+                sent.append(await send_single(chat_id, chunk[0]))
+            else:
+                group = [INPUT_MEDIA[m.get("type", "photo")](media=m["file_id"], caption=m["caption"]) for m in chunk]
+                sent.extend(await bot.send_media_group(chat_id=chat_id, media=group))
+        return sent
+    if post["kind"] == "copy":
+        sent = []
+        for i in range(0, len(post["ids"]), COPY_BATCH):
+            ids = post["ids"][i:i + COPY_BATCH]
+            if len(ids) == 1:
+                sent.append(await bot.copy_message(chat_id=chat_id, from_chat_id=post["from_chat"], message_id=ids[0]))
+            else:
+                sent.extend(await bot.copy_messages(chat_id=chat_id, from_chat_id=post["from_chat"], message_ids=ids))
+        return sent
+    if post["kind"] == "poll":
+        return await bot.send_poll(chat_id=chat_id, question=post["question"], options=post["options"], is_anonymous=True)
+    raise ValueError(f"unknown post kind: {post['kind']}")
+
+def get_targets(uid, data):
+    chans = user_channels.get(uid, {})
+    if data.get("chat_id") is not None:
+        return [chans[data["chat_id"]]] if data["chat_id"] in chans else []
+    return [chans[chat_id] for chat_id in data.get("targets") or [] if chat_id in chans]
+
+async def deliver(msg, state, post, action, details=None, done="✅ <b>Yuborildi!</b>"):
     data = await state.get_data()
-    idx = data.get("idx")
     uid = msg.from_user.id
-    if uid not in user_channels or idx >= len(user_channels[uid]):
+    targets = get_targets(uid, data)
+    await state.clear()
+    if not targets:
         await msg.answer("❌ Topilmadi!", reply_markup=get_main_menu())
-        await state.clear()
         return
-    lines = msg.text.strip().split("\n")
-    if len(lines) < 3:
-        await msg.answer("❌ Kamida savol va 2 variant!", reply_markup=get_main_menu())
+    if data.get("when"):
+        await schedule_post(msg, post, targets, action, data["when"], data.get("every") or 0)
         return
-    ch = user_channels[uid][idx]
+    if data.get("chat_id") is None:
+        job = new_broadcast(uid, msg.from_user.username or "noname", post, targets, action)
+        status = await msg.answer(f"📣 <b>Yuborilmoqda...</b>\n\n0/{len(targets)}", parse_mode="HTML")
+        await run_broadcast(status, job)
+        return
+    ch = targets[0]
     try:
-        await bot.send_poll(chat_id=ch["id"], question=lines[0], options=[l.strip() for l in lines[1:] if l.strip()], is_anonymous=True)
-        write_log(uid, msg.from_user.username or "noname", "POLL_SENT", ch['name'])
-        await msg.answer("✅ <b>Yuborildi!</b>", parse_mode="HTML", reply_markup=get_main_menu())
+        await send_post(ch["id"], post)
+        write_log(uid, msg.from_user.username or "noname", action, details or ch['name'], chat_id=ch["id"])
+        await msg.answer(done, parse_mode="HTML", reply_markup=get_main_menu())
     except Exception as e:
         await msg.answer(f"❌ {str(e)[:100]}", reply_markup=get_main_menu())
+
+# BROADCAST
+# Fan-out runs at bulk priority with at most BROADCAST_CONCURRENCY sends in flight.
+# Results are kept per chat id so "retry" only resends to the failed targets.
+async def run_pool(items, worker, limit):
+    items = iter(items)
+
+    async def drain():
+        api_priority.set(PRIORITY_BULK)
+        for item in items:
+            await worker(item)
+
+    await asyncio.gather(*(drain() for _ in range(limit)))
+
+async def run_with_progress(work, status, report):
+    work = asyncio.ensure_future(work)
+    while not (await asyncio.wait({work}, timeout=BROADCAST_PROGRESS))[0]:
+        try:
+            await status.edit_text(report(), parse_mode="HTML")
+        except Exception:
+            pass
+    return work.result()
+
+broadcast_jobs = {}
+broadcast_ids = itertools.count(1)
+
+def new_broadcast(uid, username, post, targets, action):
+    job_id = next(broadcast_ids)
+    broadcast_jobs[job_id] = {"id": job_id, "uid": uid, "username": username, "post": post, "targets": targets, "action": action, "results": {}, "running": False}
+    while len(broadcast_jobs) > 100:
+        del broadcast_jobs[next(iter(broadcast_jobs))]
+    return broadcast_jobs[job_id]
+
+def broadcast_report(job, final=False):
+    ok = sum(1 for r in job["results"].values() if r == "ok")
+    failed = [(c, job["results"][c["id"]]) for c in job["targets"] if job["results"].get(c["id"], "ok") != "ok"]
+    text = f"📣 <b>{'Yakunlandi' if final else 'Yuborilmoqda...'}</b>\n\n✅ {ok}/{len(job['targets'])}"
+    if failed:
+        text += f"\n❌ {len(failed)}"
+    if final:
+        lines = [f"{'✅' if job['results'].get(c['id']) == 'ok' else '❌'} {escape(c['name'][:25])}" for c in job["targets"]]
+        lines += [f"\n❌ {escape(c['name'][:25])}: {escape(err)}" for c, err in failed]
+        text += "\n\n" + "\n".join(lines)
+    return text[:4000], failed
+
+async def run_broadcast(status, job):
+    if job["running"]:
+        return
+    job["running"] = True
+
+    async def send_one(ch):
+        try:
+            await send_post(ch["id"], job["post"])
+            job["results"][ch["id"]] = "ok"
+        except Exception as e:
+            job["results"][ch["id"]] = str(e)[:60]
+
+    try:
+        pending = [c for c in job["targets"] if job["results"].get(c["id"]) != "ok"]
+        await run_with_progress(run_pool(pending, send_one, BROADCAST_CONCURRENCY), status, lambda: broadcast_report(job)[0])
+    finally:
+        job["running"] = False
+    text, failed = broadcast_report(job, final=True)
+    write_log(job["uid"], job["username"], job["action"], f"{len(job['targets']) - len(failed)}/{len(job['targets'])} kanal")
+    kb = [[InlineKeyboardButton(text=f"🔁 Qayta ({len(failed)})", callback_data=cbd("bretry", job['id']))]] if failed else []
+    kb.append([InlineKeyboardButton(text="🔙 Menyu", callback_data=cbd("main"))])
+    try:
+        await status.edit_text(text, parse_mode="HTML", reply_markup=InlineKeyboardMarkup(inline_keyboard=kb))
+    except Exception:
+        await status.answer(text, parse_mode="HTML", reply_markup=InlineKeyboardMarkup(inline_keyboard=kb))
+
+@callback("bcast")
+async def bcast_cb(cb: CallbackQuery, state: FSMContext):
+    selected = list(user_channels.get(cb.from_user.id, {}))
     await state.clear()
+    await state.update_data(chat_id=None, targets=selected)
+    await cb.message.edit_text(f"📣 <b>Kanallarni tanlang</b> ({len(selected)}/{len(selected)})", parse_mode="HTML", reply_markup=get_bcast_menu(cb.from_user.id, set(selected)))
+    await cb.answer()
+
+@callback("bsel", mode=str, chat_id=int)
+async def bsel_cb(cb: CallbackQuery, state: FSMContext, mode: str = None, chat_id: int = None):
+    uid = cb.from_user.id
+    chans = user_channels.get(uid, {})
+    selected = set((await state.get_data()).get("targets") or [])
+    if mode == "all":
+        selected = set(chans)
+    elif mode == "none":
+        selected = set()
+    elif mode == "tog":
+        if chat_id in chans:
+            selected ^= {chat_id}
+    await state.update_data(chat_id=None, targets=list(selected))
+    try:
+        await cb.message.edit_text(f"📣 <b>Kanallarni tanlang</b> ({len(selected)}/{len(chans)})", parse_mode="HTML", reply_markup=get_bcast_menu(uid, selected))
+    except Exception:
+        pass
+    await cb.answer()
+
+@callback("bgo")
+async def bgo_cb(cb: CallbackQuery, state: FSMContext):
+    if not get_targets(cb.from_user.id, await state.get_data()):
+        await cb.answer("❌ Kanal tanlanmagan!", show_alert=True)
+        return
+    await state.update_data(when=None, every=0)
+    await cb.message.edit_text("📤 <b>Xabar yuborish</b>", parse_mode="HTML", reply_markup=get_bcast_send_menu())
+    await cb.answer()
+
+BCAST_PROMPTS = {
+    "txt": (ChannelStates.waiting_for_message, "💬 <b>Matn yuboring:</b>"),
+    "pho": (ChannelStates.waiting_for_photo, "📸 <b>Rasm yuboring:</b>"),
+    "med": (ChannelStates.waiting_for_media_group, "🖼 <b>Rasm, video yoki fayllar yuboring</b>\n\n/done - tugadi"),
+    "pol": (ChannelStates.waiting_for_poll, "📊 <b>Format:</b>\n\nSavol\nVariant1\nVariant2"),
+    "rel": (ChannelStates.waiting_for_relay, RELAY_PROMPT),
+}
+
+@callback("bsend", kind=str)
+async def bsend_cb(cb: CallbackQuery, kind: str, state: FSMContext):
+    if kind not in BCAST_PROMPTS:
+        await cb.answer("❌ Topilmadi!", show_alert=True)
+        return
+    next_state, prompt = BCAST_PROMPTS[kind]
+    reset_album(cb.from_user.id)
+    await state.update_data(chat_id=None)
+    await state.set_state(next_state)
+    await cb.message.edit_text(prompt, parse_mode="HTML")
+    await cb.answer()
+
+@callback("bretry", job_id=int)
+async def bretry_cb(cb: CallbackQuery, job_id: int):
+    job = broadcast_jobs.get(job_id)
+    if not job or job["uid"] != cb.from_user.id:
+        await cb.answer("❌ Topilmadi!", show_alert=True)
+        return
+    await cb.answer()
+    await run_broadcast(cb.message, job)
+
+# SCHEDULE
+# Deferred posts live in scheduled_jobs and are persisted to SCHEDULE_FILE on every
+# change. One heap of (due, job id) drives schedule_loop, which sleeps until the
+# earliest due time and sends everything due by then as one batch. A job whose due
+# no longer matches its heap entry (cancelled or moved) is skipped when popped.
+scheduled_jobs = {}
+schedule_heap = []
+schedule_ids = itertools.count(1)
+schedule_wake = asyncio.Event()
+schedule_lock = asyncio.Lock()
+
+SCHEDULE_UNITS = {"m": 60, "h": 3600, "d": 86400}
+SCHEDULE_RE = re.compile(r"^(?:\+(\d+)([mhd])|(?:(\d{4}-\d{2}-\d{2}) )?(\d{1,2}):(\d{2}))(?: \*(\d+)([mhd]))?$")
+SCHEDULE_HELP = ("⏰ <b>Vaqtni yuboring:</b>\n\n<code>21:30</code> - bugun/ertaga\n<code>2026-01-31 21:30</code>\n<code>+2h</code> - 2 soatdan keyin"
+                 "\n\nTakrorlash: <code>21:30 *1d</code>, <code>+30m *12h</code>")
+
+def parse_schedule(text, now=None):
+    m = SCHEDULE_RE.match(text.strip().lower())
+    if not m:
+        raise ValueError("Format noto'g'ri!")
+    now = now or time.time()
+    if m[1]:
+        due = now + int(m[1]) * SCHEDULE_UNITS[m[2]]
+    else:
+        day = datetime.strptime(m[3], "%Y-%m-%d").date() if m[3] else datetime.fromtimestamp(now, SCHEDULE_TZ).date()
+        at = datetime(day.year, day.month, day.day, int(m[4]), int(m[5]), tzinfo=SCHEDULE_TZ)
+        if not m[3] and at.timestamp() <= now:
+            at += timedelta(days=1)
+        due = at.timestamp()
+    every = int(m[6]) * SCHEDULE_UNITS[m[7]] if m[6] else 0
+    if due <= now:
+        raise ValueError("Vaqt o'tib ketgan!")
+    if every and every < SCHEDULE_MIN_EVERY:
+        raise ValueError(f"Takrorlash kamida {SCHEDULE_MIN_EVERY // 60} min!")
+    return due, every
+
+def format_when(due, every=0):
+    text = datetime.fromtimestamp(due, SCHEDULE_TZ).strftime("%Y-%m-%d %H:%M")
+    if every:
+        unit = next(u for u in "dhm" if every % SCHEDULE_UNITS[u] == 0)
+        text += f" 🔁 {every // SCHEDULE_UNITS[unit]}{unit}"
+    return text
+
+def read_schedule(path):
+    if not os.path.exists(path):
+        return []
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f).get("jobs", [])
+
+def dump_schedule(jobs):
+    return json.dumps({"version": 1, "jobs": jobs}, ensure_ascii=False).encode("utf-8")
+
+def load_schedule():
+    global schedule_ids
+    try:
+        jobs = read_schedule(SCHEDULE_FILE)
+    except Exception as e:
+        print(f"❌ Schedule: {e}")
+        return
+    for job in jobs:
+        scheduled_jobs[job["id"]] = job
+        heapq.heappush(schedule_heap, (job["due"], job["id"]))
+    schedule_ids = itertools.count(max(scheduled_jobs, default=0) + 1)
+
+async def save_schedule():
+    dump = dump_schedule(list(scheduled_jobs.values()))
+    async with schedule_lock:
+        await asyncio.to_thread(write_atomic, SCHEDULE_FILE, dump)
+
+async def add_job(job):
+    scheduled_jobs[job["id"]] = job
+    heapq.heappush(schedule_heap, (job["due"], job["id"]))
+    schedule_wake.set()
+    await save_schedule()
+
+async def schedule_post(msg, post, targets, action, due, every):
+    uid = msg.from_user.id
+    if sum(1 for j in scheduled_jobs.values() if j["uid"] == uid) >= SCHEDULE_MAX_JOBS:
+        await msg.answer(f"❌ Maksimum {SCHEDULE_MAX_JOBS} ta!", reply_markup=get_main_menu())
+        return
+    job = {"id": next(schedule_ids), "uid": uid, "username": msg.from_user.username or "noname", "post": post,
+           "targets": [ch["id"] for ch in targets], "action": action, "due": due, "every": every}
+    try:
+        await add_job(job)
+    except Exception as e:
+        scheduled_jobs.pop(job["id"], None)
+        await msg.answer(f"❌ {str(e)[:100]}", reply_markup=get_main_menu())
+        return
+    write_log(uid, job["username"], "POST_SCHEDULED", f"{action} {format_when(due, every)} {len(targets)} kanal")
+    await msg.answer(f"⏰ <b>Rejalashtirildi!</b>\n\n📅 {format_when(due, every)}\n📢 {len(targets)} kanal\n\n/jobs", parse_mode="HTML", reply_markup=get_main_menu())
+
+async def run_scheduled(batch):
+    results = {job["id"]: [] for job in batch}
+    pairs = [(job, ch) for job in batch for ch in get_targets(job["uid"], {"targets": job["targets"]})]
+
+    async def send_one(pair):
+        job, ch = pair
+        try:
+            await send_post(ch["id"], job["post"])
+            results[job["id"]].append((ch, None))
+        except Exception as e:
+            results[job["id"]].append((ch, str(e)[:60]))
+
+    await run_pool(pairs, send_one, SCHEDULE_CONCURRENCY)
+    for job in batch:
+        done = results[job["id"]]
+        failed = [(ch, err) for ch, err in done if err]
+        write_log(job["uid"], job["username"], job["action"], f"⏰ {len(done) - len(failed)}/{len(done)} kanal")
+        text = f"⏰ <b>Rejali post #{job['id']}</b>\n\n✅ {len(done) - len(failed)}/{len(done)}"
+        text += "".join(f"\n❌ {escape(ch['name'][:25])}: {escape(err)}" for ch, err in failed)
+        try:
+            await bot.send_message(job["uid"], text[:4000], parse_mode="HTML")
+        except Exception as e:
+            print(f"❌ Schedule: {e}")
+
+async def schedule_loop():
+    while True:
+        schedule_wake.clear()
+        now = time.time()
+        batch = []
+        changed = False
+        while schedule_heap and schedule_heap[0][0] <= now:
+            due, job_id = heapq.heappop(schedule_heap)
+            job = scheduled_jobs.get(job_id)
+            if not job or job["due"] != due:
+                continue
+            changed = True
+            if SCHEDULE_CATCHUP != "skip" or now - due <= SCHEDULE_GRACE:
+                batch.append(dict(job))
+            if job["every"]:
+                # missed runs of a recurring job collapse into one; the next run is
+                # the first slot after now
+                job["due"] = due + job["every"] * (int((now - due) // job["every"]) + 1)
+                heapq.heappush(schedule_heap, (job["due"], job_id))
+            else:
+                del scheduled_jobs[job_id]
+        if changed:
+            try:
+                # saved before sending: after a crash a job is skipped, never sent twice
+                await save_schedule()
+            except Exception as e:
+                print(f"❌ Schedule: {e}")
+        if batch:
+            try:
+                await run_scheduled(batch)
+            except Exception as e:
+                print(f"❌ Schedule: {e}")
+            continue
+        timeout = schedule_heap[0][0] - time.time() if schedule_heap else None
+        try:
+            await asyncio.wait_for(schedule_wake.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+@callback("sch", chat_id=int)
+async def sch_cb(cb: CallbackQuery, state: FSMContext, chat_id: int = None):
+    if chat_id is not None:
+        await state.update_data(chat_id=chat_id)
+    await state.set_state(ChannelStates.waiting_for_schedule)
+    await cb.message.edit_text(SCHEDULE_HELP, parse_mode="HTML")
+    await cb.answer()
+
+@dp.message(ChannelStates.waiting_for_schedule)
+async def sch_proc(msg: Message, state: FSMContext):
+    try:
+        due, every = parse_schedule(msg.text or "")
+    except ValueError as e:
+        await msg.answer(f"❌ {e}\n\n{SCHEDULE_HELP}", parse_mode="HTML")
+        return
+    data = await state.get_data()
+    await state.set_state(None)
+    await state.update_data(when=due, every=every)
+    menu = get_send_menu(data["chat_id"]) if data.get("chat_id") is not None else get_bcast_send_menu()
+    await msg.answer(f"⏰ <b>{format_when(due, every)}</b>\n\n📤 Post turini tanlang:", parse_mode="HTML", reply_markup=menu)
+
+def get_jobs_menu(uid):
+    jobs = sorted((j for j in scheduled_jobs.values() if j["uid"] == uid), key=lambda j: j["due"])
+    kb = [[InlineKeyboardButton(text=f"🗑 #{j['id']} {format_when(j['due'], j['every'])}", callback_data=cbd("jdel", j['id']))] for j in jobs]
+    kb.append([InlineKeyboardButton(text="🔙 Menyu", callback_data=cbd("main"))])
+    return f"⏰ <b>Rejali postlar:</b> {len(jobs)}", InlineKeyboardMarkup(inline_keyboard=kb)
+
+@dp.message(Command("jobs"))
+async def jobs_cmd(msg: Message):
+    text, kb = get_jobs_menu(msg.from_user.id)
+    await msg.answer(text, parse_mode="HTML", reply_markup=kb)
+
+@callback("jdel", job_id=int)
+async def jdel_cb(cb: CallbackQuery, job_id: int):
+    job = scheduled_jobs.get(job_id)
+    if not job or job["uid"] != cb.from_user.id:
+        await cb.answer("❌ Topilmadi!", show_alert=True)
+        return
+    del scheduled_jobs[job["id"]]
+    await save_schedule()
+    write_log(cb.from_user.id, cb.from_user.username or "noname", "POST_UNSCHEDULED", f"#{job['id']}")
+    text, kb = get_jobs_menu(cb.from_user.id)
+    await cb.message.edit_text(text, parse_mode="HTML", reply_markup=kb)
+    await cb.answer("✅ O'chirildi!")
+
+# HEALTH
+# health_loop re-checks every registered chat once per HEALTH_INTERVAL: is the bot
+# still an admin, does the chat still exist. A chat shared by several users is
+# checked once, and the answers refresh the chat cache. A changed title, username
+# or health mark is committed as one "meta" record (chat fields are shared by all
+# owners), which also makes their channel lists show ⚠️ on stale channels.
+STALE_TEXT = {"noadmin": "⚠️ Bot admin emas!", "gone": "⚠️ Kanal topilmadi yoki bot chiqarilgan!"}
+health_stats = Counter()
+
+async def check_chat(chat_id):
+    await asyncio.sleep(random.uniform(0, HEALTH_JITTER))
+    chat = None
+    try:
+        member = await bot.get_chat_member(chat_id=chat_id, user_id=bot.id)
+        stale = None if member.status in ("administrator", "creator") else "noadmin"
+        chat = await bot.get_chat(chat_id=chat_id)
+        chat_cache.put(("chat", chat_id), chat)
+    except (TelegramBadRequest, TelegramForbiddenError):
+        stale = "gone"
+    except Exception as e:
+        # a timeout says nothing about the chat; it is checked again next sweep
+        health_stats["errors"] += 1
+        print(f"❌ Health {chat_id}: {e}")
+        return
+    health_stats["checked"] += 1
+    uid = next(iter(chat_owners.get(chat_id, ())), None)
+    ch = user_channels.get(uid, {}).get(chat_id)
+    if ch is None:
+        return
+    name = chat.title if chat and chat.title else ch["name"]
+    username = chat.username if chat else ch.get("username")
+    if (name, username, stale) != (ch["name"], ch.get("username"), ch.get("stale")):
+        commit({"op": "meta", "uid": uid, "id": chat_id, "name": name, "username": username, "stale": stale})
+
+async def health_loop():
+    await asyncio.sleep(HEALTH_DELAY)
+    while True:
+        started = time.monotonic()
+        try:
+            await run_pool(list(chat_owners), check_chat, HEALTH_CONCURRENCY)
+            health_stats["sweeps"] += 1
+        except Exception as e:
+            print(f"❌ Health: {e}")
+        await asyncio.sleep(max(0, HEALTH_INTERVAL - (time.monotonic() - started)))
+
+# GROWTH
+# growth_loop samples get_chat_member_count for every registered chat (once per
+# chat, however many owners) each GROWTH_INTERVAL. Each chat keeps two rings of
+# uint32 counts: one slot per hour for GROWTH_HOURS and one per day for GROWTH_DAYS,
+# the last sample of a period wins. 0 marks an empty slot (the bot itself is a
+# member). Series only knows the newest period of each ring; slots skipped over
+# are cleared when it advances. The info screen reads its deltas from here.
+GROWTH_MAGIC = b"GRW1"
+GROWTH_HEADER = struct.Struct("<4sII")
+GROWTH_RECORD = struct.Struct("<qII")
+growth = {}
+growth_lock = asyncio.Lock()
+
+class Series:
+    __slots__ = ("hour", "day", "hourly", "daily")
+
+    def __init__(self, hour=0, day=0, hourly=None, daily=None):
+        self.hour = hour
+        self.day = day
+        self.hourly = hourly or array("I", bytes(4 * GROWTH_HOURS))
+        self.daily = daily or array("I", bytes(4 * GROWTH_DAYS))
+
+    @staticmethod
+    def advance(ring, last, period):
+        for p in range(max(last + 1, period - len(ring) + 1), period + 1):
+            ring[p % len(ring)] = 0
+        return max(last, period)
+
+    def record(self, ts, count):
+        hour, day = int(ts // 3600), int(ts // 86400)
+        if hour <= self.hour - len(self.hourly):
+            return
+        self.hour = self.advance(self.hourly, self.hour, hour)
+        self.day = self.advance(self.daily, self.day, day)
+        self.hourly[hour % len(self.hourly)] = count
+        self.daily[day % len(self.daily)] = count
+
+    def at(self, ts):
+        hour, day = int(ts // 3600), int(ts // 86400)
+        if self.hour - len(self.hourly) < hour <= self.hour and self.hourly[hour % len(self.hourly)]:
+            return self.hourly[hour % len(self.hourly)]
+        if self.day - len(self.daily) < day <= self.day and self.daily[day % len(self.daily)]:
+            return self.daily[day % len(self.daily)]
+        return None
+
+    def latest(self):
+        return self.hourly[self.hour % len(self.hourly)] or None
+
+def growth_delta(chat_id, seconds, now=None):
+    series = growth.get(chat_id)
+    if series is None or not series.latest():
+        return None
+    past = series.at((now or time.time()) - seconds)
+    return series.latest() - past if past else None
+
+def format_growth(chat_id):
+    parts = []
+    for label, seconds in (("24 soat", 86400), ("7 kun", 7 * 86400)):
+        delta = growth_delta(chat_id, seconds)
+        if delta is not None:
+            parts.append(f"{label}: {delta:+,}")
+    return f"\n📈 {' | '.join(parts)}" if parts else ""
+
+def read_growth(path):
+    series = {}
+    if not os.path.exists(path):
+        return series
+    with open(path, "rb") as f:
+        raw = f.read()
+    magic, hours, days = GROWTH_HEADER.unpack_from(raw)
+    if magic != GROWTH_MAGIC or (hours, days) != (GROWTH_HOURS, GROWTH_DAYS):
+        print(f"❌ Growth: {path} has another layout, starting empty")
+        return series
+    pos = GROWTH_HEADER.size
+    while pos < len(raw):
+        chat_id, hour, day = GROWTH_RECORD.unpack_from(raw, pos)
+        pos += GROWTH_RECORD.size
+        rings = []
+        for size in (hours, days):
+            ring = array("I", raw[pos:pos + 4 * size])
+            if sys.byteorder != "little":
+                ring.byteswap()
+            rings.append(ring)
+            pos += 4 * size
+        series[chat_id] = Series(hour, day, *rings)
+    return series
+
+def load_growth():
+    try:
+        growth.update(read_growth(GROWTH_FILE))
+    except Exception as e:
+        print(f"❌ Growth: {e}")
+
+def dump_growth(items=None):
+    parts = [GROWTH_HEADER.pack(GROWTH_MAGIC, GROWTH_HOURS, GROWTH_DAYS)]
+    for chat_id, series in (growth if items is None else items).items():
+        parts.append(GROWTH_RECORD.pack(chat_id, series.hour, series.day))
+        for ring in (series.hourly, series.daily):
+            if sys.byteorder != "little":
+                ring = array("I", ring)
+                ring.byteswap()
+            parts.append(ring.tobytes())
+    return b"".join(parts)
+
+async def save_growth():
+    dump = dump_growth()
+    async with growth_lock:
+        await asyncio.to_thread(write_atomic, GROWTH_FILE, dump)
+
+async def sample_count(chat_id):
+    try:
+        count = await bot.get_chat_member_count(chat_id=chat_id)
+    except Exception:
+        # unreachable chats are the health sweeper's business
+        return
+    chat_cache.put(("count", chat_id), count)
+    series = growth.get(chat_id)
+    if series is None:
+        series = growth[chat_id] = Series()
+    series.record(time.time(), count)
+
+async def growth_loop():
+    api_priority.set(PRIORITY_BULK)
+    await asyncio.sleep(GROWTH_DELAY)
+    while True:
+        started = time.monotonic()
+        try:
+            await run_pool(list(chat_owners), sample_count, GROWTH_CONCURRENCY)
+            for chat_id in [chat_id for chat_id in growth if chat_id not in chat_owners]:
+                del growth[chat_id]
+            await save_growth()
+        except Exception as e:
+            print(f"❌ Growth: {e}")
+        await asyncio.sleep(max(0, GROWTH_INTERVAL - (time.monotonic() - started)))
 
 # PICTURE
-@dp.callback_query(F.data.startswith("pic_"))
-async def pic_cb(cb: CallbackQuery):
-    idx = int(cb.data.split("_")[1])
-    await cb.message.edit_text("🖼 <b>Kanal rasmi</b>", parse_mode="HTML", reply_markup=get_pic_menu(idx))
+@callback("pic", chat_id=int)
+async def pic_cb(cb: CallbackQuery, chat_id: int):
+    await cb.message.edit_text("🖼 <b>Kanal rasmi</b>", parse_mode="HTML", reply_markup=get_pic_menu(chat_id))
     await cb.answer()
 
-@dp.callback_query(F.data.startswith("setpic_"))
-async def setpic_cb(cb: CallbackQuery, state: FSMContext):
-    idx = int(cb.data.split("_")[1])
-    await state.update_data(idx=idx)
+@callback("setpic", chat_id=int)
+async def setpic_cb(cb: CallbackQuery, chat_id: int, state: FSMContext):
+    await state.update_data(chat_id=chat_id)
     await state.set_state(ChannelStates.waiting_for_chat_photo)
     await cb.message.edit_text("🖼 <b>Rasm yuboring:</b>", parse_mode="HTML")
     await cb.answer()
@@ -445,56 +2493,47 @@ async def setpic_cb(cb: CallbackQuery, state: FSMContext):
 @dp.message(ChannelStates.waiting_for_chat_photo, F.photo)
 async def setpic_proc(msg: Message, state: FSMContext):
     data = await state.get_data()
-    idx = data.get("idx")
     uid = msg.from_user.id
-    if uid not in user_channels or idx >= len(user_channels[uid]):
+    ch = user_channels.get(uid, {}).get(data.get("chat_id"))
+    if not ch:
         await msg.answer("❌ Topilmadi!", reply_markup=get_main_menu())
         await state.clear()
         return
-    ch = user_channels[uid][idx]
-    path = f"temp_{uid}.jpg"
     try:
-        file = await bot.get_file(msg.photo[-1].file_id)
-        await bot.download_file(file.file_path, path)
-        with open(path, 'rb') as photo:
-            await bot.set_chat_photo(chat_id=ch["id"], photo=photo)
-        if os.path.exists(path):
-            os.remove(path)
-        write_log(uid, msg.from_user.username or "noname", "PIC_SET", ch['name'])
+        photo = await fetch_media(msg.photo[-1])
+        await bot.set_chat_photo(chat_id=ch["id"], photo=BufferedInputFile(photo, filename="photo.jpg"))
+        invalidate_chat(ch["id"])
+        write_log(uid, msg.from_user.username or "noname", "PIC_SET", ch['name'], chat_id=ch["id"])
         await msg.answer("✅ <b>O'rnatildi!</b>", parse_mode="HTML", reply_markup=get_main_menu())
     except Exception as e:
         await msg.answer(f"❌ {str(e)[:100]}", reply_markup=get_main_menu())
-        if os.path.exists(path):
-            os.remove(path)
     await state.clear()
 
-@dp.callback_query(F.data.startswith("delpic_"))
-async def delpic_cb(cb: CallbackQuery):
-    idx = int(cb.data.split("_")[1])
+@callback("delpic", chat_id=int)
+async def delpic_cb(cb: CallbackQuery, chat_id: int):
     uid = cb.from_user.id
-    if uid not in user_channels or idx >= len(user_channels[uid]):
+    ch = user_channels.get(uid, {}).get(chat_id)
+    if not ch:
         await cb.answer("❌ Topilmadi!", show_alert=True)
         return
-    ch = user_channels[uid][idx]
     try:
         await bot.delete_chat_photo(chat_id=ch["id"])
-        write_log(uid, cb.from_user.username or "noname", "PIC_DEL", ch['name'])
+        invalidate_chat(ch["id"])
+        write_log(uid, cb.from_user.username or "noname", "PIC_DEL", ch['name'], chat_id=ch["id"])
         await cb.message.edit_text("✅ <b>O'chirildi!</b>", parse_mode="HTML", reply_markup=get_main_menu())
     except Exception as e:
         await cb.answer(f"❌ {str(e)[:50]}", show_alert=True)
     await cb.answer()
 
 # PIN
-@dp.callback_query(F.data.startswith("pin_"))
-async def pin_cb(cb: CallbackQuery):
-    idx = int(cb.data.split("_")[1])
-    await cb.message.edit_text("📌 <b>Pin</b>", parse_mode="HTML", reply_markup=get_pin_menu(idx))
+@callback("pin", chat_id=int)
+async def pin_cb(cb: CallbackQuery, chat_id: int):
+    await cb.message.edit_text("📌 <b>Pin</b>", parse_mode="HTML", reply_markup=get_pin_menu(chat_id))
     await cb.answer()
 
-@dp.callback_query(F.data.startswith("dopin_"))
-async def dopin_cb(cb: CallbackQuery, state: FSMContext):
-    idx = int(cb.data.split("_")[1])
-    await state.update_data(idx=idx)
+@callback("dopin", chat_id=int)
+async def dopin_cb(cb: CallbackQuery, chat_id: int, state: FSMContext):
+    await state.update_data(chat_id=chat_id)
     await state.set_state(ChannelStates.waiting_for_pin_message)
     await cb.message.edit_text("📌 <b>Xabar ID:</b>", parse_mode="HTML")
     await cb.answer()
@@ -502,17 +2541,16 @@ async def dopin_cb(cb: CallbackQuery, state: FSMContext):
 @dp.message(ChannelStates.waiting_for_pin_message)
 async def dopin_proc(msg: Message, state: FSMContext):
     data = await state.get_data()
-    idx = data.get("idx")
     uid = msg.from_user.id
-    if uid not in user_channels or idx >= len(user_channels[uid]):
+    ch = user_channels.get(uid, {}).get(data.get("chat_id"))
+    if not ch:
         await msg.answer("❌ Topilmadi!", reply_markup=get_main_menu())
         await state.clear()
         return
-    ch = user_channels[uid][idx]
     try:
         msg_id = int(msg.text.strip())
         await bot.pin_chat_message(chat_id=ch["id"], message_id=msg_id)
-        write_log(uid, msg.from_user.username or "noname", "PINNED", f"ID: {msg_id}")
+        write_log(uid, msg.from_user.username or "noname", "PINNED", f"ID: {msg_id}", chat_id=ch["id"])
         await msg.answer("✅ <b>Pin qilindi!</b>", parse_mode="HTML", reply_markup=get_main_menu())
     except ValueError:
         await msg.answer("❌ Faqat raqam!", reply_markup=get_main_menu())
@@ -520,49 +2558,45 @@ async def dopin_proc(msg: Message, state: FSMContext):
         await msg.answer(f"❌ {str(e)[:100]}", reply_markup=get_main_menu())
     await state.clear()
 
-@dp.callback_query(F.data.startswith("unpin_"))
-async def unpin_cb(cb: CallbackQuery):
-    idx = int(cb.data.split("_")[1])
+@callback("unpin", chat_id=int)
+async def unpin_cb(cb: CallbackQuery, chat_id: int):
     uid = cb.from_user.id
-    if uid not in user_channels or idx >= len(user_channels[uid]):
+    ch = user_channels.get(uid, {}).get(chat_id)
+    if not ch:
         await cb.answer("❌ Topilmadi!", show_alert=True)
         return
-    ch = user_channels[uid][idx]
     try:
         await bot.unpin_chat_message(chat_id=ch["id"])
-        write_log(uid, cb.from_user.username or "noname", "UNPINNED", ch['name'])
+        write_log(uid, cb.from_user.username or "noname", "UNPINNED", ch['name'], chat_id=ch["id"])
         await cb.message.edit_text("✅ <b>Unpin!</b>", parse_mode="HTML", reply_markup=get_main_menu())
     except Exception as e:
         await cb.answer(f"❌ {str(e)[:50]}", show_alert=True)
     await cb.answer()
 
-@dp.callback_query(F.data.startswith("unpinall_"))
-async def unpinall_cb(cb: CallbackQuery):
-    idx = int(cb.data.split("_")[1])
+@callback("unpinall", chat_id=int)
+async def unpinall_cb(cb: CallbackQuery, chat_id: int):
     uid = cb.from_user.id
-    if uid not in user_channels or idx >= len(user_channels[uid]):
+    ch = user_channels.get(uid, {}).get(chat_id)
+    if not ch:
         await cb.answer("❌ Topilmadi!", show_alert=True)
         return
-    ch = user_channels[uid][idx]
     try:
         await bot.unpin_all_chat_messages(chat_id=ch["id"])
-        write_log(uid, cb.from_user.username or "noname", "UNPINNED_ALL", ch['name'])
+        write_log(uid, cb.from_user.username or "noname", "UNPINNED_ALL", ch['name'], chat_id=ch["id"])
         await cb.message.edit_text("✅ <b>Hammasi unpin!</b>", parse_mode="HTML", reply_markup=get_main_menu())
     except Exception as e:
         await cb.answer(f"❌ {str(e)[:50]}", show_alert=True)
     await cb.answer()
 
 # MEMBERS
-@dp.callback_query(F.data.startswith("mem_"))
-async def mem_cb(cb: CallbackQuery):
-    idx = int(cb.data.split("_")[1])
-    await cb.message.edit_text("👥 <b>A'zolar</b>", parse_mode="HTML", reply_markup=get_member_menu(idx))
+@callback("mem", chat_id=int)
+async def mem_cb(cb: CallbackQuery, chat_id: int):
+    await cb.message.edit_text("👥 <b>A'zolar</b>", parse_mode="HTML", reply_markup=get_member_menu(chat_id))
     await cb.answer()
 
-@dp.callback_query(F.data.startswith("ban_"))
-async def ban_cb(cb: CallbackQuery, state: FSMContext):
-    idx = int(cb.data.split("_")[1])
-    await state.update_data(idx=idx)
+@callback("ban", chat_id=int)
+async def ban_cb(cb: CallbackQuery, chat_id: int, state: FSMContext):
+    await state.update_data(chat_id=chat_id)
     await state.set_state(ChannelStates.waiting_for_ban_user)
     await cb.message.edit_text("🚫 <b>User ID:</b>", parse_mode="HTML")
     await cb.answer()
@@ -570,17 +2604,16 @@ async def ban_cb(cb: CallbackQuery, state: FSMContext):
 @dp.message(ChannelStates.waiting_for_ban_user)
 async def ban_proc(msg: Message, state: FSMContext):
     data = await state.get_data()
-    idx = data.get("idx")
     uid = msg.from_user.id
-    if uid not in user_channels or idx >= len(user_channels[uid]):
+    ch = user_channels.get(uid, {}).get(data.get("chat_id"))
+    if not ch:
         await msg.answer("❌ Topilmadi!", reply_markup=get_main_menu())
         await state.clear()
         return
-    ch = user_channels[uid][idx]
     try:
         ban_uid = int(msg.text.strip())
         await bot.ban_chat_member(chat_id=ch["id"], user_id=ban_uid)
-        write_log(uid, msg.from_user.username or "noname", "BANNED", f"User: {ban_uid}")
+        write_log(uid, msg.from_user.username or "noname", "BANNED", f"User: {ban_uid}", chat_id=ch["id"])
         await msg.answer(f"✅ <b>Ban!</b>\n\n👤 {ban_uid}", parse_mode="HTML", reply_markup=get_main_menu())
     except ValueError:
         await msg.answer("❌ Faqat raqam!", reply_markup=get_main_menu())
@@ -588,10 +2621,9 @@ async def ban_proc(msg: Message, state: FSMContext):
         await msg.answer(f"❌ {str(e)[:100]}", reply_markup=get_main_menu())
     await state.clear()
 
-@dp.callback_query(F.data.startswith("unb_"))
-async def unb_cb(cb: CallbackQuery, state: FSMContext):
-    idx = int(cb.data.split("_")[1])
-    await state.update_data(idx=idx)
+@callback("unb", chat_id=int)
+async def unb_cb(cb: CallbackQuery, chat_id: int, state: FSMContext):
+    await state.update_data(chat_id=chat_id)
     await state.set_state(ChannelStates.waiting_for_unban_user)
     await cb.message.edit_text("✅ <b>User ID:</b>", parse_mode="HTML")
     await cb.answer()
@@ -599,17 +2631,16 @@ async def unb_cb(cb: CallbackQuery, state: FSMContext):
 @dp.message(ChannelStates.waiting_for_unban_user)
 async def unb_proc(msg: Message, state: FSMContext):
     data = await state.get_data()
-    idx = data.get("idx")
     uid = msg.from_user.id
-    if uid not in user_channels or idx >= len(user_channels[uid]):
+    ch = user_channels.get(uid, {}).get(data.get("chat_id"))
+    if not ch:
         await msg.answer("❌ Topilmadi!", reply_markup=get_main_menu())
         await state.clear()
         return
-    ch = user_channels[uid][idx]
     try:
         unban_uid = int(msg.text.strip())
         await bot.unban_chat_member(chat_id=ch["id"], user_id=unban_uid)
-        write_log(uid, msg.from_user.username or "noname", "UNBANNED", f"User: {unban_uid}")
+        write_log(uid, msg.from_user.username or "noname", "UNBANNED", f"User: {unban_uid}", chat_id=ch["id"])
         await msg.answer(f"✅ <b>Unban!</b>\n\n👤 {unban_uid}", parse_mode="HTML", reply_markup=get_main_menu())
     except ValueError:
         await msg.answer("❌ Faqat raqam!", reply_markup=get_main_menu())
@@ -617,10 +2648,9 @@ async def unb_proc(msg: Message, state: FSMContext):
         await msg.answer(f"❌ {str(e)[:100]}", reply_markup=get_main_menu())
     await state.clear()
 
-@dp.callback_query(F.data.startswith("res_"))
-async def res_cb(cb: CallbackQuery, state: FSMContext):
-    idx = int(cb.data.split("_")[1])
-    await state.update_data(idx=idx)
+@callback("res", chat_id=int)
+async def res_cb(cb: CallbackQuery, chat_id: int, state: FSMContext):
+    await state.update_data(chat_id=chat_id)
     await state.set_state(ChannelStates.waiting_for_restrict_user)
     await cb.message.edit_text("⚠️ <b>User ID:</b>", parse_mode="HTML")
     await cb.answer()
@@ -628,18 +2658,17 @@ async def res_cb(cb: CallbackQuery, state: FSMContext):
 @dp.message(ChannelStates.waiting_for_restrict_user)
 async def res_proc(msg: Message, state: FSMContext):
     data = await state.get_data()
-    idx = data.get("idx")
     uid = msg.from_user.id
-    if uid not in user_channels or idx >= len(user_channels[uid]):
+    ch = user_channels.get(uid, {}).get(data.get("chat_id"))
+    if not ch:
         await msg.answer("❌ Topilmadi!", reply_markup=get_main_menu())
         await state.clear()
         return
-    ch = user_channels[uid][idx]
     try:
         res_uid = int(msg.text.strip())
         perms = ChatPermissions(can_send_messages=False, can_send_media_messages=False, can_send_polls=False)
         await bot.restrict_chat_member(chat_id=ch["id"], user_id=res_uid, permissions=perms, until_date=datetime.now() + timedelta(days=365))
-        write_log(uid, msg.from_user.username or "noname", "RESTRICTED", f"User: {res_uid}")
+        write_log(uid, msg.from_user.username or "noname", "RESTRICTED", f"User: {res_uid}", chat_id=ch["id"])
         await msg.answer(f"✅ <b>Restrict!</b>\n\n👤 {res_uid}", parse_mode="HTML", reply_markup=get_main_menu())
     except ValueError:
         await msg.answer("❌ Faqat raqam!", reply_markup=get_main_menu())
@@ -647,10 +2676,9 @@ async def res_proc(msg: Message, state: FSMContext):
         await msg.answer(f"❌ {str(e)[:100]}", reply_markup=get_main_menu())
     await state.clear()
 
-@dp.callback_query(F.data.startswith("pro_"))
-async def pro_cb(cb: CallbackQuery, state: FSMContext):
-    idx = int(cb.data.split("_")[1])
-    await state.update_data(idx=idx)
+@callback("pro", chat_id=int)
+async def pro_cb(cb: CallbackQuery, chat_id: int, state: FSMContext):
+    await state.update_data(chat_id=chat_id)
     await state.set_state(ChannelStates.waiting_for_promote_user)
     await cb.message.edit_text("⭐️ <b>User ID:</b>", parse_mode="HTML")
     await cb.answer()
@@ -658,17 +2686,16 @@ async def pro_cb(cb: CallbackQuery, state: FSMContext):
 @dp.message(ChannelStates.waiting_for_promote_user)
 async def pro_proc(msg: Message, state: FSMContext):
     data = await state.get_data()
-    idx = data.get("idx")
     uid = msg.from_user.id
-    if uid not in user_channels or idx >= len(user_channels[uid]):
+    ch = user_channels.get(uid, {}).get(data.get("chat_id"))
+    if not ch:
         await msg.answer("❌ Topilmadi!", reply_markup=get_main_menu())
         await state.clear()
         return
-    ch = user_channels[uid][idx]
     try:
         pro_uid = int(msg.text.strip())
         await bot.promote_chat_member(chat_id=ch["id"], user_id=pro_uid, can_manage_chat=True, can_post_messages=True, can_edit_messages=True, can_delete_messages=True, can_restrict_members=True, can_promote_members=False, can_change_info=True, can_invite_users=True, can_pin_messages=True)
-        write_log(uid, msg.from_user.username or "noname", "PROMOTED", f"User: {pro_uid}")
+        write_log(uid, msg.from_user.username or "noname", "PROMOTED", f"User: {pro_uid}", chat_id=ch["id"])
         await msg.answer(f"✅ <b>Admin!</b>\n\n👤 {pro_uid}", parse_mode="HTML", reply_markup=get_main_menu())
     except ValueError:
         await msg.answer("❌ Faqat raqam!", reply_markup=get_main_menu())
@@ -676,63 +2703,311 @@ async def pro_proc(msg: Message, state: FSMContext):
         await msg.answer(f"❌ {str(e)[:100]}", reply_markup=get_main_menu())
     await state.clear()
 
+# BULK MODERATION
+# IDs come from a message or a .txt/.csv file, are deduplicated, and every
+# (channel, user) pair is processed by a BULK_CONCURRENCY worker pool.
+BULK_ACTIONS = {"ban": ("BULK_BANNED", "🚫 Ban"), "unb": ("BULK_UNBANNED", "✅ Unban"), "res": ("BULK_RESTRICTED", "⚠️ Restrict")}
+
+def parse_user_ids(text):
+    ids, skipped = [], 0
+    for token in re.split(r"[\s,;]+", text):
+        # str.isdigit() also accepts "²", which int() rejects
+        if re.fullmatch(r"\d+", token, re.ASCII):
+            ids.append(int(token))
+        elif token:
+            skipped += 1
+    unique = list(dict.fromkeys(ids))
+    return unique, skipped + len(ids) - len(unique)
+
+async def moderate(action, chat_id, user_id):
+    if action == "ban":
+        await bot.ban_chat_member(chat_id=chat_id, user_id=user_id)
+    elif action == "unb":
+        await bot.unban_chat_member(chat_id=chat_id, user_id=user_id)
+    elif action == "res":
+        perms = ChatPermissions(can_send_messages=False, can_send_media_messages=False, can_send_polls=False)
+        await bot.restrict_chat_member(chat_id=chat_id, user_id=user_id, permissions=perms, until_date=datetime.now() + timedelta(days=365))
+
+def bulk_report(job, final=False):
+    done = job["ok"] + sum(job["errors"].values())
+    text = f"📋 <b>{job['title']}</b>{'' if final else ' ...'}\n\n⏳ {done}/{job['total']}\n✅ {job['ok']}\n❌ {sum(job['errors'].values())}\n⏭ {job['skipped']}"
+    if final and job["errors"]:
+        text += "\n\n" + "\n".join(f"• {n}× {escape(err)}" for err, n in job["errors"].most_common(5))
+    return text
+
+@callback("bulk", chat_id=int)
+async def bulk_cb(cb: CallbackQuery, chat_id: int):
+    await cb.message.edit_text("📋 <b>Ommaviy moderatsiya</b>", parse_mode="HTML", reply_markup=get_bulk_menu(chat_id))
+    await cb.answer()
+
+@callback("bmod", action=str, target=chat_target)
+async def bmod_cb(cb: CallbackQuery, action: str, target: int | str, state: FSMContext):
+    if action not in BULK_ACTIONS:
+        await cb.answer("❌ Topilmadi!", show_alert=True)
+        return
+    await state.clear()
+    if target == "all":
+        await state.update_data(bulk_action=action, chat_id=None, targets=list(user_channels.get(cb.from_user.id, {})))
+    else:
+        await state.update_data(bulk_action=action, chat_id=target)
+    await state.set_state(ChannelStates.waiting_for_bulk_ids)
+    await cb.message.edit_text(f"{BULK_ACTIONS[action][1]}\n\n📋 <b>User ID ro'yxati</b> (matn yoki .txt/.csv fayl)", parse_mode="HTML")
+    await cb.answer()
+
+@dp.message(ChannelStates.waiting_for_bulk_ids)
+async def bulk_proc(msg: Message, state: FSMContext):
+    data = await state.get_data()
+    uid = msg.from_user.id
+    targets = get_targets(uid, data)
+    if not targets:
+        await msg.answer("❌ Topilmadi!", reply_markup=get_main_menu())
+        await state.clear()
+        return
+    if msg.document:
+        if not (msg.document.file_name or "").lower().endswith((".txt", ".csv")) or (msg.document.file_size or 0) > BULK_MAX_BYTES:
+            await msg.answer(f"❌ Faqat .txt/.csv, {BULK_MAX_BYTES // 1024} KB gacha!")
+            return
+        text = (await bot.download(msg.document, destination=io.BytesIO())).getvalue().decode("utf-8", "replace")
+    else:
+        text = msg.text or ""
+    user_ids, skipped = parse_user_ids(text)
+    if not user_ids:
+        await msg.answer("❌ ID topilmadi!")
+        return
+    if len(user_ids) > BULK_MAX_IDS:
+        await msg.answer(f"❌ Ko'pi bilan {BULK_MAX_IDS} ta!")
+        return
+    await state.clear()
+    action = data["bulk_action"]
+    log_action, title = BULK_ACTIONS[action]
+    job = {"title": title, "total": len(user_ids) * len(targets), "ok": 0, "errors": Counter(), "skipped": skipped}
+
+    async def apply_one(pair):
+        ch, user_id = pair
+        try:
+            await moderate(action, ch["id"], user_id)
+            job["ok"] += 1
+        except Exception as e:
+            job["errors"][str(e)[:60]] += 1
+
+    status = await msg.answer(bulk_report(job), parse_mode="HTML")
+    pairs = ((ch, user_id) for ch in targets for user_id in user_ids)
+    await run_with_progress(run_pool(pairs, apply_one, BULK_CONCURRENCY), status, lambda: bulk_report(job))
+    write_log(uid, msg.from_user.username or "noname", log_action, f"{job['ok']}/{job['total']} | {len(targets)} kanal")
+    try:
+        await status.edit_text(bulk_report(job, final=True), parse_mode="HTML", reply_markup=get_main_menu())
+    except Exception:
+        await msg.answer(bulk_report(job, final=True), parse_mode="HTML", reply_markup=get_main_menu())
+
+# INVITES
+# invite_pool[chat_id] keeps the chat's primary link and its live expiring links
+# (shared by all owners, persisted to INVITE_FILE). The primary link is read from
+# get_chat instead of exported, because export_chat_invite_link revokes the
+# previous one; only "♻️ Yangilash" does that.
+# Bots get no join counts without chat_member updates, so a link with a member
+# limit could be handed out long after it is full: with INVITE_LIMIT set every
+# tap mints a fresh link. With INVITE_LIMIT=0 a tap reuses a link still valid for
+# INVITE_REFRESH seconds and invite_loop mints the replacement before that window,
+# for chats whose link was asked for in the last INVITE_IDLE seconds.
+invite_pool = {}
+invite_locks = {}
+invite_lock = asyncio.Lock()
+
+def read_invites(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f).get("chats", {})
+
+def dump_invites(chats):
+    return json.dumps({"version": 1, "chats": chats}, ensure_ascii=False).encode("utf-8")
+
+def load_invites():
+    try:
+        chats = read_invites(INVITE_FILE)
+    except Exception as e:
+        print(f"❌ Invites: {e}")
+        return
+    now = time.time()
+    for chat_id, entry in chats.items():
+        entry["links"] = [link for link in entry.get("links", []) if link["expire"] > now]
+        invite_pool[int(chat_id)] = entry
+
+async def save_invites():
+    dump = dump_invites(invite_pool)
+    async with invite_lock:
+        await asyncio.to_thread(write_atomic, INVITE_FILE, dump)
+
+def invite_entry(chat_id):
+    return invite_pool.setdefault(chat_id, {"primary": None, "links": [], "used": 0})
+
+def live_link(entry, now=None):
+    if INVITE_LIMIT:
+        return None
+    now = now or time.time()
+    links = [link for link in entry["links"] if link["expire"] - now > INVITE_REFRESH and link["limit"] == INVITE_LIMIT]
+    return max(links, key=lambda link: link["expire"], default=None)
+
+async def mint_link(chat_id):
+    expire = int(time.time()) + INVITE_TTL
+    link = await bot.create_chat_invite_link(chat_id=chat_id, expire_date=expire, member_limit=INVITE_LIMIT or None)
+    record = {"link": link.invite_link, "expire": expire, "limit": INVITE_LIMIT}
+    if not INVITE_LIMIT:
+        entry = invite_entry(chat_id)
+        entry["links"] = [old for old in entry["links"] if old["expire"] > time.time()]
+        entry["links"].append(record)
+    return record
+
+async def limited_link(chat_id, renew=False):
+    if INVITE_LIMIT:
+        return await mint_link(chat_id), True
+    entry = invite_entry(chat_id)
+    entry["used"] = int(time.time())
+    link = None if renew else live_link(entry)
+    if link:
+        return link, False
+    async with invite_locks.setdefault(chat_id, asyncio.Lock()):
+        link = (None if renew else live_link(entry)) or await mint_link(chat_id)
+    await save_invites()
+    return link, True
+
+async def primary_link(chat_id, renew=False):
+    entry = invite_entry(chat_id)
+    if entry["primary"] and not renew:
+        return entry["primary"], False
+    async with invite_locks.setdefault(chat_id, asyncio.Lock()):
+        if renew:
+            entry["primary"] = await bot.export_chat_invite_link(chat_id=chat_id)
+            invalidate_chat(chat_id)
+        elif not entry["primary"]:
+            chat = await cached_chat(chat_id)
+            entry["primary"] = chat.invite_link or await bot.export_chat_invite_link(chat_id=chat_id)
+    await save_invites()
+    return entry["primary"], True
+
+async def invite_loop():
+    api_priority.set(PRIORITY_BULK)
+    while True:
+        await asyncio.sleep(INVITE_INTERVAL)
+        now = time.time()
+        changed = False
+        for chat_id, entry in list(invite_pool.items()):
+            links = [link for link in entry["links"] if link["expire"] > now]
+            if chat_id not in chat_owners or (not links and not entry["primary"] and now - entry["used"] > INVITE_IDLE):
+                del invite_pool[chat_id]
+                changed = True
+                continue
+            changed |= len(links) != len(entry["links"])
+            entry["links"] = links
+            if not entry["used"] or now - entry["used"] > INVITE_IDLE or live_link(entry, now + INVITE_INTERVAL):
+                continue
+            try:
+                async with invite_locks.setdefault(chat_id, asyncio.Lock()):
+                    await mint_link(chat_id)
+                changed = True
+            except Exception as e:
+                print(f"❌ Invite {chat_id}: {e}")
+        if changed:
+            try:
+                await save_invites()
+            except Exception as e:
+                print(f"❌ Invites: {e}")
+
+def link_back_menu(action, chat_id):
+    return InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="♻️ Yangilash", callback_data=cbd(action, chat_id, 1))],
+                                                 [InlineKeyboardButton(text="🔙 Orqaga", callback_data=cbd("main"))]])
+
 # LINKS
-@dp.callback_query(F.data.startswith("link_"))
-async def link_cb(cb: CallbackQuery):
-    idx = int(cb.data.split("_")[1])
-    await cb.message.edit_text("🔗 <b>Havolalar</b>", parse_mode="HTML", reply_markup=get_link_menu(idx))
+@callback("link", chat_id=int)
+async def link_cb(cb: CallbackQuery, chat_id: int):
+    await cb.message.edit_text("🔗 <b>Havolalar</b>", parse_mode="HTML", reply_markup=get_link_menu(chat_id))
     await cb.answer()
 
-@dp.callback_query(F.data.startswith("explink_"))
-async def explink_cb(cb: CallbackQuery):
-    idx = int(cb.data.split("_")[1])
+@callback("crtlink", chat_id=int, renew=int)
+async def crtlink_cb(cb: CallbackQuery, chat_id: int, renew: int = 0):
     uid = cb.from_user.id
-    if uid not in user_channels or idx >= len(user_channels[uid]):
+    ch = user_channels.get(uid, {}).get(chat_id)
+    if not ch:
         await cb.answer("❌ Topilmadi!", show_alert=True)
         return
-    ch = user_channels[uid][idx]
     try:
-        link = await bot.export_chat_invite_link(chat_id=ch["id"])
-        write_log(uid, cb.from_user.username or "noname", "LINK_EXPORTED", ch['name'])
-        await cb.message.edit_text(f"🔗 <b>Doimiy havola:</b>\n\n{link}", parse_mode="HTML", reply_markup=InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="🔙 Orqaga", callback_data="main")]]))
+        link, created = await limited_link(ch["id"], renew=bool(renew))
+        if created:
+            write_log(uid, cb.from_user.username or "noname", "LINK_CREATED", ch['name'], chat_id=ch["id"])
+        limit = link["limit"] or "∞"
+        await cb.message.edit_text(f"⏰ <b>Cheklangan:</b>\n\n{link['link']}\n\n⏰ {format_when(link['expire'])} gacha | 👥 {limit}", parse_mode="HTML", reply_markup=link_back_menu("crtlink", chat_id))
     except Exception as e:
         await cb.answer(f"❌ {str(e)[:50]}", show_alert=True)
     await cb.answer()
 
-@dp.callback_query(F.data.startswith("crtlink_"))
-async def crtlink_cb(cb: CallbackQuery):
-    idx = int(cb.data.split("_")[1])
+@callback("explink", chat_id=int, renew=int)
+async def explink_cb(cb: CallbackQuery, chat_id: int, renew: int = 0):
     uid = cb.from_user.id
-    if uid not in user_channels or idx >= len(user_channels[uid]):
+    ch = user_channels.get(uid, {}).get(chat_id)
+    if not ch:
         await cb.answer("❌ Topilmadi!", show_alert=True)
         return
-    ch = user_channels[uid][idx]
     try:
-        link = await bot.create_chat_invite_link(chat_id=ch["id"], expire_date=datetime.now() + timedelta(days=1), member_limit=100)
-        write_log(uid, cb.from_user.username or "noname", "LINK_CREATED", ch['name'])
-        await cb.message.edit_text(f"⏰ <b>Cheklangan:</b>\n\n{link.invite_link}\n\n⏰ 24h | 👥 100", parse_mode="HTML", reply_markup=InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="🔙 Orqaga", callback_data="main")]]))
+        link, created = await primary_link(ch["id"], renew=bool(renew))
+        if created:
+            write_log(uid, cb.from_user.username or "noname", "LINK_EXPORTED", ch['name'], chat_id=ch["id"])
+        await cb.message.edit_text(f"🔗 <b>Doimiy havola:</b>\n\n{link}", parse_mode="HTML", reply_markup=link_back_menu("explink", chat_id))
     except Exception as e:
         await cb.answer(f"❌ {str(e)[:50]}", show_alert=True)
     await cb.answer()
 
 # ADMIN
+def collect_stats():
+    cache = chat_cache.stats
+    return {"users": len(user_channels), "channels": registry_stats["channels"], "stale": registry_stats["stale"], "chat_ids": list(chat_owners),
+            "fsm_live": fsm_storage.live, "fsm_hot": len(fsm_storage.hot), "fsm_bytes": fsm_storage.footprint(),
+            "cache_size": len(chat_cache.entries), "hits": cache["hits"], "misses": cache["misses"], "coalesced": cache["coalesced"],
+            "updates": metric_total("bot_update_seconds"), "update_seconds": metric_total("bot_update_seconds", "sum"),
+            "handler_errors": metric_total("bot_handler_errors_total", "counter"), "api_calls": metric_total("bot_api_seconds"),
+            "api_seconds": metric_total("bot_api_seconds", "sum"), "api_errors": metric_total("bot_api_errors_total", "counter"),
+            "api_429": metric_total("bot_api_retry_after_total", "counter")}
+
+def format_stats(st):
+    return (f"📊 <b>STATISTIKA</b>\n\n👥 Users: {st['users']}\n📢 Channels: {st['channels']} ({len(set(st['chat_ids']))} unique) | ⚠️ {st['stale']}"
+            f"\n\n🧠 FSM: {st['fsm_live']} aktiv | {st['fsm_hot']} hot | ~{st['fsm_bytes'] // 1024} KB"
+            f"\n🗂 Cache: {st['cache_size']} | ✅ {st['hits']} | ❌ {st['misses']} | 🔗 {st['coalesced']}"
+            f"\n\n⚡ Updates: {st['updates']} | ~{st['update_seconds'] * 1000 / max(st['updates'], 1):.0f} ms | ❌ {st['handler_errors']}"
+            f"\n🛰 API: {st['api_calls']} | ~{st['api_seconds'] * 1000 / max(st['api_calls'], 1):.0f} ms | ❌ {st['api_errors']} | ⏳ 429: {st['api_429']}")
+
 @dp.message(Command("stats"))
 async def stats_cmd(msg: Message):
     if msg.from_user.id != ADMIN_ID:
         return
-    total_users = len(user_channels)
-    total_channels = sum(len(ch) for ch in user_channels.values())
-    await msg.answer(f"📊 <b>STATISTIKA</b>\n\n👥 Users: {total_users}\n📢 Channels: {total_channels}", parse_mode="HTML")
+    await msg.answer(format_stats(collect_stats()), parse_mode="HTML")
+
+@dp.message(Command("profile"))
+async def profile_cmd(msg: Message):
+    global profile_task
+    if msg.from_user.id != ADMIN_ID:
+        return
+    args = msg.text.split()[1:]
+    if not args:
+        lines = format_slow()
+        await msg.answer("🐢 <b>Eng sekin updatelar</b>\n\n" + escape("\n".join(lines) if lines else "Yo'q")[:3900] + "\n\n/profile 60 - profil", parse_mode="HTML")
+        return
+    if not re.fullmatch(r"\d+", args[0], re.ASCII):
+        await msg.answer("❌ /profile 60")
+        return
+    if profile_task and not profile_task.done():
+        await msg.answer("⏳ Profil ishlayapti!")
+        return
+    seconds = max(1, min(int(args[0]), PROFILE_MAX_SECONDS))
+    profile_task = asyncio.create_task(run_profile(msg.chat.id, seconds))
+    await msg.answer(f"⏱ <b>Profil boshlandi:</b> {seconds}s", parse_mode="HTML")
 
 @dp.message(Command("logs"))
 async def logs_cmd(msg: Message):
     if msg.from_user.id != ADMIN_ID:
         return
     try:
-        if os.path.exists(LOG_FILE):
-            await msg.answer_document(FSInputFile(LOG_FILE), caption="📋 <b>Logs</b>", parse_mode="HTML")
-        else:
-            await msg.answer("❌ Yo'q")
+        q = parse_log_query(msg.text.split()[1:])
+        await flush_logs()
+        await send_logs(msg.chat.id, [LOG_DB], q)
     except Exception as e:
         await msg.answer(f"❌ {e}")
 
@@ -741,6 +3016,7 @@ async def backup_cmd(msg: Message):
     if msg.from_user.id != ADMIN_ID:
         return
     try:
+        await compact_data()
         if os.path.exists(DATA_FILE):
             await msg.answer_document(FSInputFile(DATA_FILE), caption="💾 <b>Backup</b>", parse_mode="HTML")
         else:
@@ -753,11 +3029,32 @@ async def unknown_msg(msg: Message):
     await msg.answer("❓ /start", reply_markup=get_main_menu())
 
 # MAIN
+# the registry is loaded once every section is defined: ensure_layout rebuilds
+# the schedule, invite, growth, FSM and log files with their sections' helpers
+user_channels = load_data()
+background_tasks = []
+
 async def on_startup():
+    warm_keyboards()
+    load_schedule()
+    load_invites()
+    load_growth()
+    await start_metrics()
+    background_tasks.append(asyncio.create_task(compact_loop()))
+    background_tasks.append(asyncio.create_task(schedule_loop()))
+    if HEALTH_INTERVAL:
+        background_tasks.append(asyncio.create_task(health_loop()))
+    if GROWTH_INTERVAL:
+        background_tasks.append(asyncio.create_task(growth_loop()))
+    background_tasks.append(asyncio.create_task(invite_loop()))
+    background_tasks.append(asyncio.create_task(log_loop()))
+    background_tasks.append(asyncio.create_task(notify_loop()))
     print("="*40)
     print("🚀 BOT ISHGA TUSHDI!")
     print(f"📊 Users: {len(user_channels)}")
     print("="*40)
+    if SHARD_ID:
+        return
     try:
         await bot.send_message(ADMIN_ID, f"✅ <b>Bot ishga tushdi!</b>\n\n📊 {len(user_channels)} users", parse_mode="HTML")
     except:
@@ -765,17 +3062,341 @@ async def on_startup():
 
 async def on_shutdown():
     print("\n🛑 To'xtatildi!")
-    save_data(user_channels)
+    try:
+        await asyncio.wait_for(updates_idle.wait(), SHUTDOWN_DRAIN_TIMEOUT)
+    except asyncio.TimeoutError:
+        print(f"⚠️ {updates_running} update tugamadi")
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    await stop_metrics()
+    try:
+        await compact_data()
+    except Exception as e:
+        print(f"❌ Compact: {e}")
+    try:
+        await flush_logs()
+    except Exception as e:
+        print(f"❌ Log: {e}")
+    try:
+        await flush_notifications()
+    except Exception as e:
+        print(f"❌ Notify: {e}")
+    try:
+        await dp.fsm.close()
+    except Exception as e:
+        print(f"❌ FSM: {e}")
+    if SHARD_ID:
+        return
     try:
         await bot.send_message(ADMIN_ID, "🛑 <b>Bot to'xtatildi!</b>", parse_mode="HTML")
     except:
         pass
 
+# WEBHOOK
+# The HTTP handler only checks the secret, parses the update and queues it, so
+# Telegram gets its 200 at once; WEBHOOK_WORKERS tasks feed the queue to dp.
+# Without WEBHOOK_URL the server just listens locally (recorded updates can be
+# POSTed to it) and setWebhook is skipped.
+async def webhook_handler(request):
+    if WEBHOOK_SECRET and not hmac.compare_digest(request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), WEBHOOK_SECRET):
+        return web.Response(status=401)
+    try:
+        update = Update.model_validate(await request.json(), context={"bot": bot})
+    except Exception:
+        return web.Response(status=400)
+    try:
+        request.app["queue"].put_nowait(update)
+    except asyncio.QueueFull:
+        return web.Response(status=503)
+    return web.Response()
+
+async def update_worker(queue):
+    while True:
+        update = await queue.get()
+        try:
+            await dp.feed_update(bot, update)
+        except Exception as e:
+            print(f"❌ Update {update.update_id}: {e}")
+        finally:
+            queue.task_done()
+
+async def run_webhook():
+    if not WEBHOOK_SECRET and WEBHOOK_HOST not in ("127.0.0.1", "localhost", "::1"):
+        raise SystemExit(f"❌ WEBHOOK_SECRET yo'q: {WEBHOOK_HOST} ga faqat WEBHOOK_URL yoki WEBHOOK_SECRET bilan ochiladi")
+    queue = asyncio.Queue(maxsize=WEBHOOK_QUEUE)
+    app = web.Application()
+    app["queue"] = queue
+    app.router.add_post(WEBHOOK_PATH, webhook_handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            asyncio.get_running_loop().add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+    await dp.emit_startup(bot=bot, **dp.workflow_data)
+    workers = [asyncio.create_task(update_worker(queue)) for _ in range(WEBHOOK_WORKERS)]
+    site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT)
+    await site.start()
+    print(f"🌐 Webhook: {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    try:
+        if WEBHOOK_URL:
+            await bot.set_webhook(WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET, allowed_updates=dp.resolve_used_update_types())
+        await stop.wait()
+    finally:
+        await site.stop()
+        try:
+            await asyncio.wait_for(queue.join(), WEBHOOK_DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            print(f"⚠️ {queue.qsize()} update qoldi")
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        await runner.cleanup()
+        await dp.emit_shutdown(bot=bot, **dp.workflow_data)
+
+# SHARDING
+# SHARDS=N runs a front process that polls Telegram and routes every update by
+# from_user.id % N to one of N worker processes (this file with SHARD_ID set).
+# Each worker owns its users' registry, journal, logs and FSM files; updates are
+# JSON lines on its stdin and control replies are JSON lines on its stdout.
+# /stats and /backup are answered by the front from all shards.
+def update_user_id(update):
+    user = getattr(update.event, "from_user", None)
+    return user.id if user else 0
+
+class UserSerialFeeder:
+    def __init__(self, limit):
+        self.pending = {}
+        self.sem = asyncio.Semaphore(limit)
+        self.tasks = set()
+
+    def submit(self, user_id, update):
+        if user_id in self.pending:
+            self.pending[user_id].append(update)
+            return
+        self.pending[user_id] = deque([update])
+        task = asyncio.create_task(self.drain(user_id))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def drain(self, user_id):
+        queue = self.pending[user_id]
+        try:
+            while queue:
+                async with self.sem:
+                    try:
+                        await dp.feed_update(bot, queue[0])
+                    except Exception as e:
+                        print(f"❌ Update {queue[0].update_id}: {e}")
+                queue.popleft()
+        finally:
+            del self.pending[user_id]
+
+    async def join(self):
+        while self.tasks:
+            await asyncio.gather(*list(self.tasks), return_exceptions=True)
+
+def shard_reply(payload):
+    sys.stdout.write(json.dumps(payload, ensure_ascii=False) + "\n")
+    sys.stdout.flush()
+
+async def run_shard_worker():
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, lambda: None)
+        except (NotImplementedError, RuntimeError):
+            pass
+    reader = asyncio.StreamReader(limit=2 ** 24)
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+    feeder = UserSerialFeeder(SHARD_CONCURRENCY)
+    await dp.emit_startup(bot=bot, **dp.workflow_data)
+    try:
+        while line := await reader.readline():
+            msg = json.loads(line)
+            if "update" in msg:
+                update = Update.model_validate(msg["update"], context={"bot": bot})
+                feeder.submit(update_user_id(update), update)
+            elif msg["op"] == "stats":
+                shard_reply({"reply": msg["id"], "stats": collect_stats()})
+            elif msg["op"] == "backup":
+                await compact_data()
+                shard_reply({"reply": msg["id"], "file": os.path.abspath(DATA_FILE)})
+            elif msg["op"] == "logs":
+                await flush_logs()
+                shard_reply({"reply": msg["id"], "file": os.path.abspath(LOG_DB)})
+    finally:
+        await feeder.join()
+        await dp.emit_shutdown(bot=bot, **dp.workflow_data)
+
+class ShardPool:
+    def __init__(self, count):
+        self.count = count
+        self.procs = [None] * count
+        self.readers = []
+        self.replies = {}
+        self.ids = itertools.count(1)
+        self.stopping = False
+        self.spawned = asyncio.Condition()
+
+    async def spawn(self, shard):
+        env = {**os.environ, "SHARD_ID": str(shard), "SHARDS": str(self.count), "BOT_MODE": "shard"}
+        self.procs[shard] = await asyncio.create_subprocess_exec(sys.executable, os.path.abspath(__file__), env=env, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, limit=2 ** 26)
+        self.readers.append(asyncio.create_task(self.read(shard, self.procs[shard])))
+        async with self.spawned:
+            self.spawned.notify_all()
+
+    async def start(self):
+        for shard in range(self.count):
+            await self.spawn(shard)
+
+    async def read(self, shard, proc):
+        while line := await proc.stdout.readline():
+            try:
+                msg = json.loads(line)
+            except ValueError:
+                msg = None
+            if isinstance(msg, dict) and msg.get("reply") in self.replies:
+                fut = self.replies.pop(msg["reply"])
+                if not fut.done():
+                    fut.set_result(msg)
+            else:
+                sys.stdout.write(f"[{shard}] {line.decode('utf-8', 'replace')}")
+        await proc.wait()
+        if not self.stopping:
+            print(f"❌ Shard {shard} to'xtadi ({proc.returncode}), qayta ishga tushirilmoqda")
+            await self.spawn(shard)
+
+    async def send(self, shard, payload):
+        # a dead worker fails the write before read() has respawned it: wait for
+        # the new process and try once more
+        line = (json.dumps(payload, ensure_ascii=False) + "\n").encode("utf-8")
+        for attempt in range(2):
+            proc = self.procs[shard]
+            try:
+                proc.stdin.write(line)
+                await proc.stdin.drain()
+                return
+            except (ConnectionError, RuntimeError):
+                if attempt or self.stopping:
+                    raise
+            async with self.spawned:
+                await asyncio.wait_for(self.spawned.wait_for(lambda: self.procs[shard] is not proc), SHARD_RESPAWN_TIMEOUT)
+
+    async def route(self, update):
+        shard = shard_of(update_user_id(update))
+        try:
+            await self.send(shard, {"update": update.model_dump(mode="json", exclude_none=True)})
+        except Exception as e:
+            print(f"❌ Shard {shard}: update {update.update_id} tashlandi: {e!r}")
+
+    async def ask(self, op, timeout=60):
+        futs = []
+        for shard in range(self.count):
+            req = next(self.ids)
+            self.replies[req] = asyncio.get_running_loop().create_future()
+            futs.append(self.replies[req])
+            await self.send(shard, {"op": op, "id": req})
+        return await asyncio.wait_for(asyncio.gather(*futs), timeout)
+
+    async def stop(self):
+        self.stopping = True
+        for proc in self.procs:
+            proc.stdin.close()
+        await asyncio.gather(*(proc.wait() for proc in self.procs))
+        await asyncio.gather(*self.readers, return_exceptions=True)
+
+async def front_admin(pool, msg):
+    command = msg.text.split()[0].split("@")[0]
+    if command == "/stats":
+        shards = [r["stats"] for r in await pool.ask("stats")]
+        total = {key: sum(st[key] for st in shards) for key in shards[0] if key != "chat_ids"}
+        total["chat_ids"] = [chat_id for st in shards for chat_id in st["chat_ids"]]
+        await bot.send_message(msg.chat.id, format_stats(total) + f"\n\n🧩 Shards: {len(shards)}", parse_mode="HTML")
+        return True
+    if command == "/backup":
+        users = {}
+        for reply in await pool.ask("backup"):
+            if os.path.exists(reply["file"]):
+                with open(reply["file"], "r", encoding="utf-8") as f:
+                    users.update(json.load(f)["users"])
+        dump = json.dumps({"version": DATA_VERSION, "users": users}, ensure_ascii=False).encode("utf-8")
+        await bot.send_document(msg.chat.id, BufferedInputFile(dump, filename=BASE_DATA_FILE), caption="💾 <b>Backup</b>", parse_mode="HTML")
+        return True
+    if command == "/logs":
+        try:
+            q = parse_log_query(msg.text.split()[1:])
+        except ValueError as e:
+            await bot.send_message(msg.chat.id, f"❌ {e}")
+            return True
+        await send_logs(msg.chat.id, [reply["file"] for reply in await pool.ask("logs")], q)
+        return True
+    return False
+
+async def run_sharded():
+    pool = ShardPool(SHARDS)
+    await pool.start()
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            asyncio.get_running_loop().add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+    await bot.delete_webhook()
+    allowed = dp.resolve_used_update_types()
+    offset = None
+    stopped = asyncio.ensure_future(stop.wait())
+    print(f"🧩 Shards: {SHARDS}")
+    try:
+        while not stop.is_set():
+            poll = asyncio.ensure_future(bot.get_updates(offset=offset, timeout=30, allowed_updates=allowed))
+            await asyncio.wait({poll, stopped}, return_when=asyncio.FIRST_COMPLETED)
+            if not poll.done():
+                poll.cancel()
+                break
+            try:
+                updates = poll.result()
+            except Exception as e:
+                print(f"❌ Polling: {e}")
+                await asyncio.sleep(1)
+                continue
+            for update in updates:
+                offset = update.update_id + 1
+                msg = update.message
+                if msg and msg.from_user and msg.from_user.id == ADMIN_ID and (msg.text or "").startswith(("/stats", "/backup", "/logs")):
+                    try:
+                        if await front_admin(pool, msg):
+                            continue
+                    except Exception as e:
+                        await bot.send_message(msg.chat.id, f"❌ {e}")
+                        continue
+                await pool.route(update)
+    finally:
+        stopped.cancel()
+        if offset is not None:
+            try:
+                await bot.get_updates(offset=offset, timeout=0, allowed_updates=allowed)
+            except Exception:
+                pass
+        await pool.stop()
+
 async def main():
     dp.startup.register(on_startup)
     dp.shutdown.register(on_shutdown)
     try:
-        await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+        if BOT_MODE == "shard":
+            await run_shard_worker()
+        elif SHARDS > 1:
+            await run_sharded()
+        elif BOT_MODE == "webhook":
+            await run_webhook()
+        else:
+            await bot.delete_webhook()
+            await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
     finally:
         await bot.session.close()
 